@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+
+# This script is used for checking that deduplication drops near duplicates which are just above the threshold.
+# Random programs are paired with copies which have a few tokens changed. Every copy whose signature agrees with its
+# original's on at least the threshold should be found by the LSH index.
+
+
+# IMPORTS #
+
+
+import dedup
+
+import argparse
+import numpy as np
+import sys
+
+
+# CONSTANTS #
+
+
+PROGRAM_LENGTH = 400
+# Tokens are drawn from this many code points, far more than shingles need to be unlikely to repeat
+ALPHABET_SIZE = 5000
+MAX_CHANGED_TOKENS = 12
+MIN_RECALL = 0.98
+
+
+# ARGPARSE #
+
+
+parser = argparse.ArgumentParser(description='Check near duplicates above the threshold are dropped', prog='CBT')
+parser.add_argument('--threshold', help='The similarity threshold to check, the default is {}'.format(dedup.DEFAULT_THRESHOLD), type=float, default=dedup.DEFAULT_THRESHOLD)
+parser.add_argument('--pairs', help='The number of program pairs, the default is 2000', type=int, default=2000)
+parser.add_argument('--seed', help='The random seed, the default is 0', type=int, default=0)
+
+
+# FUNCTIONS #
+
+
+def random_program(random):
+    return ''.join(chr(0x100 + i) for i in random.randint(0, ALPHABET_SIZE, PROGRAM_LENGTH))
+
+
+def change_tokens(program, random):
+    tokens = list(program)
+    for i in random.randint(0, len(tokens), random.randint(1, MAX_CHANGED_TOKENS + 1)):
+        tokens[i] = chr(0x100 + random.randint(0, ALPHABET_SIZE))
+    return ''.join(tokens)
+
+
+# MAIN #
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    random = np.random.RandomState(args.seed)
+    originals = [random_program(random) for _ in range(args.pairs)]
+    copies = [change_tokens(program, random) for program in originals]
+
+    hash_parameters = dedup.get_hash_parameters()
+    original_signatures = dedup.get_signatures(originals, hash_parameters)
+    copy_signatures = dedup.get_signatures(copies, hash_parameters)
+    index = dedup.LSHIndex(args.threshold)
+    for signature in original_signatures:
+        index.add(signature)
+    print('{} bands of {} rows'.format(index.bands, index.rows))
+
+    # Only pairs find_duplicate would accept count, i.e. their whole signatures agree on at least the threshold
+    agreements = np.mean(original_signatures == copy_signatures, axis=1)
+    above = np.flatnonzero(agreements >= args.threshold)
+    if not len(above):
+        parser.error('No pairs are above the threshold, try a lower one')
+    dropped = np.array([index.find_duplicate(copy_signatures[i]) is not None for i in above], dtype=bool)
+
+    edges = [args.threshold, args.threshold + (1 - args.threshold) / 3, args.threshold + (1 - args.threshold) * 2 / 3, 1.0001]
+    for low, high in zip(edges, edges[1:]):
+        in_range = (agreements[above] >= low) & (agreements[above] < high)
+        if in_range.any():
+            print('Similarity {:.2f} to {:.2f}: {} of {} dropped'.format(low, min(high, 1), dropped[in_range].sum(), in_range.sum()))
+    recall = dropped.mean()
+    print('{} of {} pairs above the threshold dropped ({:.3f})'.format(dropped.sum(), len(above), recall))
+    sys.exit(0 if recall >= MIN_RECALL else 1)
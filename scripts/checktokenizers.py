@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+
+# This script is used for checking that the single pass python tokenizer gives the same tokens as the ast round trip.
+# The ast path reformats the source through astunparse, so programs are compared in that canonical form, and variable
+# tokens are compared up to the order they were numbered in.
+
+
+# IMPORTS #
+
+
+import iteratortools as it
+import programtokenizer
+
+import argparse
+import ast
+import astunparse
+import os
+import sys
+import time
+import warnings
+
+
+# CONSTANTS #
+
+
+DEFAULT_PROGRAMS_PATH = os.path.join(it.REPO_ROOT_PATH, 'data', 'python_files_use_this')
+DIFF_CONTEXT = 60
+
+
+# ARGPARSE #
+
+
+parser = argparse.ArgumentParser(description='Check the single pass python tokenizer against the ast tokenizer', prog='CBT')
+parser.add_argument('paths', help='Python files or directories of them, the default is the python evaluation programs', nargs='*')
+parser.add_argument('--show_diffs', help='Print where each mismatched program first differs', action='store_true')
+
+
+# FUNCTIONS #
+
+
+def get_python_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    if file_name.endswith('.py'):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+
+def number_variables(tokenized):
+    # Variable tokens are numbered in the order the ast visits names, which isn't always source order
+    variables = {}
+    return ''.join('<{}>'.format(variables.setdefault(char, len(variables))) if ord(char) >= programtokenizer.utf8char else char
+                   for char in tokenized)
+
+
+def compare(program):
+    # Returns the two tokenizations, numbered, and the time each took, or None for programs the check doesn't apply to
+    try:
+        start = time.perf_counter()
+        ast_tokenized = programtokenizer.tokenize_python(program)
+        ast_time = time.perf_counter() - start
+        canonical = astunparse.unparse(ast.parse(program))
+    except Exception:
+        return None
+    # astunparse doesn't write f-strings back in the form it parses them
+    if 'f"' in canonical or "f'" in canonical:
+        return None
+    start = time.perf_counter()
+    single_pass_tokenized = programtokenizer.tokenize_python(canonical, single_pass=True)
+    single_pass_time = time.perf_counter() - start
+    return number_variables(ast_tokenized), number_variables(single_pass_tokenized), ast_time, single_pass_time
+
+
+def first_difference(a, b):
+    return next((i for i in range(min(len(a), len(b))) if a[i] != b[i]), min(len(a), len(b)))
+
+
+# MAIN #
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    file_paths = list(get_python_files(args.paths or [DEFAULT_PROGRAMS_PATH]))
+
+    checked = mismatched = skipped = 0
+    ast_time = single_pass_time = 0.0
+    for file_path in file_paths:
+        with open(file_path, encoding='utf8', errors='replace') as f:
+            result = compare(f.read())
+        if result is None:
+            skipped += 1
+            continue
+        ast_tokenized, single_pass_tokenized, program_ast_time, program_single_pass_time = result
+        checked += 1
+        ast_time += program_ast_time
+        single_pass_time += program_single_pass_time
+        if ast_tokenized != single_pass_tokenized:
+            mismatched += 1
+            print('Mismatch: {}'.format(file_path))
+            if args.show_diffs:
+                i = first_difference(ast_tokenized, single_pass_tokenized)
+                print('  ast:         {!r}'.format(ast_tokenized[max(0, i - DIFF_CONTEXT):i + DIFF_CONTEXT]))
+                print('  single pass: {!r}'.format(single_pass_tokenized[max(0, i - DIFF_CONTEXT):i + DIFF_CONTEXT]))
+
+    print('{} of {} programs match, {} skipped'.format(checked - mismatched, checked, skipped))
+    if single_pass_time:
+        print('ast {:.2f}s, single pass {:.2f}s ({:.1f}x faster)'.format(ast_time, single_pass_time, ast_time / single_pass_time))
+    sys.exit(1 if mismatched else 0)
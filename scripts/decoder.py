@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+
+# This script is used for running a trained model one token at a time with compiled steps, passing the LSTM state
+# in and out explicitly instead of keeping it in a stateful layer.
+
+
+# IMPORTS #
+
+
+import model_maker
+import numpydecoder
+
+import tensorflow as tf
+import numpy as np
+import os
+import tempfile
+
+
+# FUNCTIONS #
+
+
+class Decoder:
+    # Wraps a model from model_maker.build_inference_model. States are (h, c) pairs of (batch, rnn_units) arrays.
+    def __init__(self, inference_model):
+        self.model = inference_model
+        self.rnn_units = inference_model.inputs[1].shape[-1]
+        state_spec = tf.TensorSpec([None, self.rnn_units], tf.float32)
+        self.compiled_prime = tf.function(self.run_prime, input_signature=[
+            tf.TensorSpec([None, None], tf.int32), state_spec, state_spec
+        ])
+        self.compiled_step = tf.function(self.run_step, input_signature=[
+            tf.TensorSpec([None], tf.int32), state_spec, state_spec, tf.TensorSpec([], tf.float32), tf.TensorSpec([], tf.int32)
+        ])
+
+    def run_prime(self, token_ids, state_h, state_c):
+        logits, state_h, state_c = self.model([token_ids, state_h, state_c])
+        return logits[:, -1, :], state_h, state_c
+
+    def run_step(self, token_ids, state_h, state_c, temperature, top_k):
+        logits, state_h, state_c = self.model([token_ids[:, None], state_h, state_c])
+        logits = logits[:, 0, :]
+        # Only the top_k most likely tokens can be sampled, all of them if top_k is 0
+        k = tf.where(top_k > 0, tf.minimum(top_k, tf.shape(logits)[1]), tf.shape(logits)[1])
+        threshold = tf.math.top_k(logits, k=k).values[:, -1:]
+        sampling_logits = tf.where(logits < threshold, tf.fill(tf.shape(logits), float('-inf')), logits / temperature)
+        # using a categorical distribution to predict the word returned by the model
+        sampled_ids = tf.random.categorical(sampling_logits, num_samples=1, dtype=tf.int32)[:, 0]
+        # The log probability under the model itself, whatever the temperature
+        log_probs = tf.gather(tf.nn.log_softmax(logits), sampled_ids, batch_dims=1)
+        return sampled_ids, log_probs, state_h, state_c
+
+    def get_initial_state(self, batch_size):
+        return np.zeros((batch_size, self.rnn_units), np.float32), np.zeros((batch_size, self.rnn_units), np.float32)
+
+    def prime(self, token_ids, state):
+        # Runs (batch, length) token ids through the model, returns the logits after the last one and the new state
+        logits, state_h, state_c = self.compiled_prime(np.asarray(token_ids, np.int32), state[0], state[1])
+        return logits.numpy(), (state_h.numpy(), state_c.numpy())
+
+    def sample(self, token_ids, state, temperature=1.0, top_k=0):
+        # Feeds one token per row and samples the next, returns the sampled ids, their log probabilities and the new state
+        sampled_ids, log_probs, state_h, state_c = self.compiled_step(
+            np.asarray(token_ids, np.int32), state[0], state[1], tf.constant(temperature, tf.float32),
+            tf.constant(top_k, tf.int32))
+        return sampled_ids.numpy(), log_probs.numpy(), (state_h.numpy(), state_c.numpy())
+
+
+def export_weights(config, vocab_size, checkpoint_dir):
+    # Writes the latest checkpoint's weights to the file numpydecoder.NumpyDecoder reads
+    embedding, kernel, recurrent_kernel, bias, dense_kernel, dense_bias = \
+        model_maker.load_inference_model(config, vocab_size, checkpoint_dir).get_weights()
+    weights_path = os.path.join(checkpoint_dir, numpydecoder.WEIGHTS_FILE)
+    # A temp file per process, so processes exporting the same checkpoint never write into each other's
+    fd, temp_path = tempfile.mkstemp(suffix='.npz', dir=checkpoint_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, checkpoint=os.path.basename(tf.train.latest_checkpoint(checkpoint_dir)),
+                     embedding=embedding, kernel=kernel, recurrent_kernel=recurrent_kernel, bias=bias,
+                     dense_kernel=dense_kernel, dense_bias=dense_bias)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, weights_path)
+    return weights_path
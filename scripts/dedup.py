@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+
+# This script is used for finding near duplicate tokenized programs with MinHash signatures and locality sensitive
+# hashing, so the many almost identical solutions to a problem are only trained on once.
+
+
+# IMPORTS #
+
+
+import numpy as np
+
+
+# CONSTANTS #
+
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 128
+DEFAULT_THRESHOLD = 0.85
+# The chance a pair of programs exactly at the threshold becomes a candidate
+MIN_RECALL = 0.99
+# Fixed so signatures are the same in every worker process and between runs
+HASH_SEED = 1729
+SHINGLE_BASE = np.uint64(1000003)
+UINT32_MAX = np.iinfo(np.uint32).max
+
+
+# FUNCTIONS #
+
+
+def get_hash_parameters(num_perm=NUM_PERMUTATIONS, seed=HASH_SEED):
+    # Multiply-shift hash functions, (a * x + b) >> 32 on 64 bit integers, one (a, b) pair per permutation
+    random = np.random.RandomState(seed)
+    a = random.randint(0, 2 ** 32, size=(num_perm, 2), dtype=np.uint64)
+    b = random.randint(0, 2 ** 32, size=(num_perm, 2), dtype=np.uint64)
+    a = (a[:, 0] << np.uint64(32)) | a[:, 1] | np.uint64(1)
+    b = (b[:, 0] << np.uint64(32)) | b[:, 1]
+    return a[:, None], b[:, None]
+
+
+def get_shingle_hashes(tokenized):
+    # 32 bit hashes of every SHINGLE_SIZE tokens in a row, a polynomial hash which wraps around in uint64
+    code_points = np.frombuffer(tokenized.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.uint64)
+    if len(code_points) < SHINGLE_SIZE:
+        code_points = np.concatenate([code_points, np.zeros(SHINGLE_SIZE - len(code_points), dtype=np.uint64)])
+    num_shingles = len(code_points) - SHINGLE_SIZE + 1
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(SHINGLE_SIZE):
+            hashes = hashes * SHINGLE_BASE + code_points[i:i + num_shingles]
+    return np.unique(hashes >> np.uint64(32))
+
+
+def get_signature(tokenized, hash_parameters):
+    a, b = hash_parameters
+    with np.errstate(over='ignore'):
+        return ((a * get_shingle_hashes(tokenized) + b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+def get_signatures(programs, hash_parameters=None):
+    # Returns a (len(programs), num_perm) array, one MinHash signature per tokenized program
+    if hash_parameters is None:
+        hash_parameters = get_hash_parameters()
+    signatures = np.full((len(programs), len(hash_parameters[0])), UINT32_MAX, dtype=np.uint32)
+    for i, tokenized in enumerate(programs):
+        signatures[i] = get_signature(tokenized, hash_parameters)
+    return signatures
+
+
+def get_candidate_probability(similarity, bands, rows):
+    # The chance two programs this similar agree on every row of at least one band
+    return 1 - (1 - similarity ** rows) ** bands
+
+
+def get_band_shape(threshold, num_perm=NUM_PERMUTATIONS, recall=MIN_RECALL):
+    # Candidates are checked on their whole signature, so the S curve is put well below the threshold to find almost
+    # every duplicate. Of the (bands, rows) splits which do, the one with the most rows finds the fewest candidates.
+    # The last num_perm % rows values of the signature aren't in any band.
+    shapes = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return max((shape for shape in shapes if get_candidate_probability(threshold, *shape) >= recall),
+               key=lambda shape: shape[1], default=shapes[0])
+
+
+class LSHIndex:
+    # Programs whose signatures agree on every row of some band are candidates, candidates are then compared on their
+    # whole signature, so a duplicate is only dropped when its estimated similarity really is above the threshold
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERMUTATIONS):
+        self.threshold = threshold
+        self.bands, self.rows = get_band_shape(threshold, num_perm)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = []
+
+    def get_band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def find_duplicate(self, signature):
+        # The index of an added signature similar to this one, or None
+        checked = set()
+        for bucket, key in zip(self.buckets, self.get_band_keys(signature)):
+            for candidate in bucket.get(key, ()):
+                if candidate not in checked:
+                    checked.add(candidate)
+                    if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                        return candidate
+        return None
+
+    def add(self, signature):
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        for bucket, key in zip(self.buckets, self.get_band_keys(signature)):
+            bucket.setdefault(key, []).append(index)
+        return index
+
+    def add_if_unique(self, signature):
+        # Returns whether the signature was added, the first of a group of near duplicates is the one kept
+        if self.find_duplicate(signature) is not None:
+            return False
+        self.add(signature)
+        return True
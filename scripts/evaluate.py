@@ -11,8 +11,8 @@
 import iteratortools as it
 import generator
 import train
-import model_maker
 import evaluator
+import prefixcache
 
 import subprocess
 import os
@@ -21,9 +21,9 @@ import argparse
 import json
 import shutil
 import re
-import tensorflow as tf
 import operator
 import collections
+import itertools
 
 
 # CONSTANTS #
@@ -42,6 +42,7 @@ parser.add_argument('checkpoint_dir', help='The directory of the most recent tra
 parser.add_argument('language', help='Pick a programming language to evaluate.', choices=['py', 'c'])
 parser.add_argument('output_environment', help='Distinct name of the directory where the evaluator will do its work, necessary if many of this script are run parallel')
 parser.add_argument('--lines', help='The number of lines to remove and then generate, the default is 1', type=int, choices=range(1,21), default=1)
+parser.add_argument('--batch_size', help='The number of files generated together, the default is {}'.format(generator.DEFAULT_BATCH_SIZE), type=int, default=generator.DEFAULT_BATCH_SIZE)
 parser.add_argument('--num_files', help='Specify the number of files to evaluate, helpful if theres heaps to reduce work load', type=int, default=-1)
 
 
@@ -79,28 +80,32 @@ def write_output_file(output_file_path, modified_text):
 def generate_model_output(generated_content, language):
     progress_bar = it.ProgressBar(0, len(generated_content))
     progress_bar.print_progress_bar()
-    # Use model to generate evaulation set
+    # Use model to generate evaulation set, a batch of files at a time
     to_be_removed = []
-    for i, item in enumerate(generated_content):
-        try:
+    for batch in it.chunks(generated_content, batch_size):
+        gen_start_strings = []
+        for item in batch:
             # Read contents of file
-            file_path = item['file_name']
-            gen_start_string = ''
-            with open(file_path, 'r', encoding='utf8') as f:
-                gen_start_string = f.read()
-
-            model_output, generated_lines = generator.generate_text(model, language, gen_start_string, num_lines, state['index_to_token'], state['variable_char_start'])
-            with open(file_path, 'w') as output_file:
-                output_file.writelines(model_output)
-            generated_content[i].update({
-                'generated_lines': generated_lines
-            })
-        except Exception as e:
-            progress_bar.increment_errors()
-            to_be_removed.append(item)
-        finally:
-            progress_bar.increment_work()
-            progress_bar.print_progress_bar()
+            with open(item['file_name'], 'r', encoding='utf8') as f:
+                gen_start_strings.append(f.read())
+
+        results = generator.generate_text_batch(decoder, language, gen_start_strings, num_lines, state['index_to_token'], state['variable_char_start'], state.get('single_pass_tokenizer', False), prefix_cache)
+        for item, result in zip(batch, results):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                model_output, generated_lines = result
+                with open(item['file_name'], 'w') as output_file:
+                    output_file.writelines(model_output)
+                item.update({
+                    'generated_lines': generated_lines
+                })
+            except Exception as e:
+                progress_bar.increment_errors()
+                to_be_removed.append(item)
+            finally:
+                progress_bar.increment_work()
+                progress_bar.print_progress_bar()
 
     for remove_me in to_be_removed:
         generated_content.remove(remove_me)
@@ -142,6 +147,7 @@ if __name__ == '__main__':
     language = args.language
     environment = args.output_environment
     num_files = args.num_files
+    batch_size = args.batch_size
 
     environment = os.path.join(it.REPO_ROOT_PATH, 'data', environment)
 
@@ -159,7 +165,8 @@ if __name__ == '__main__':
     # Remove last n lines from file and write to new file.
     print('Preparing evaluation set...')
     if language == 'c':
-        programs = [file_path for file_path in it.get_lang_files(language, evaluation_only=True)] if num_files == -1 else [file_path for file_path in it.get_lang_files(language, evaluation_only=True)[:num_files]]
+        eval_programs = it.iter_lang_files(language, evaluation_only=True)
+        programs = list(eval_programs) if num_files == -1 else list(itertools.islice(eval_programs, num_files))
         # programs.pop(12)
         # programs.pop(13)
         # programs.pop(14)
@@ -195,9 +202,8 @@ if __name__ == '__main__':
     with open(os.path.join(checkpoint_dir, train.WORD_TO_INDEX_FILE)) as json_file:
         print('Building model...')
         state = json.load(json_file)
-        model = model_maker.build_model(int(state['vocab_size']), model_maker.EMBEDDING_DIMENSION, model_maker.RNN_UNITS, batch_size=1)
-        model.load_weights(tf.train.latest_checkpoint(checkpoint_dir))
-        model.build(tf.TensorShape([1, None]))
+        decoder = generator.load_decoder(checkpoint_dir, int(state['vocab_size']), use_tensorflow=True)
+        prefix_cache = prefixcache.PrefixStateCache()
 
         print('Generating model output...')
         generated_content = generate_model_output(generated_content, language)
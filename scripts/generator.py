@@ -1,17 +1,30 @@
-import tensorflow as tf
+import numpy as np
 import iteratortools as it
-import model_maker
+import modelconfig
+import numpydecoder
+import prefixcache
 import argparse
 import programtokenizer
 import json
-import train
 import os
 import sys
 import tempfile
 import subprocess
 import uuid
+import collections
 #tf.enable_eager_execution()
 
+# CONSTANTS #
+
+
+MAX_LINE_LENGTH = 100
+DEFAULT_BATCH_SIZE = 16
+# Low temperatures results in more predictable text.
+# Higher temperatures results in more surprising text.
+# Experiment to find the best setting.
+DEFAULT_TEMPERATURE = 1.0
+
+
 # ARGPARSE #
 
 
@@ -21,6 +34,12 @@ parser.add_argument('language', help='The language being generated')
 parser.add_argument('--Cin', help='Provide input via the console')
 parser.add_argument('--Fin', help='Specify a python file to take as input')
 parser.add_argument('--Fout', help='Specify a file to output to')
+parser.add_argument('--Jin', help='Specify a jsonl file of {"prompt": ...} objects to generate from in batches, output is written as jsonl')
+parser.add_argument('--batch_size', help='The number of --Jin prompts generated together, the default is {}'.format(DEFAULT_BATCH_SIZE), type=int, default=DEFAULT_BATCH_SIZE)
+parser.add_argument('--tensorflow', help='Generate with the compiled tensorflow model instead of the numpy one, which starts faster', action='store_true')
+parser.add_argument('--samples', help='Sample this many candidates from one priming of the seed and output them most likely first, the default is 1', type=int, default=1)
+parser.add_argument('--temperature', help='Divides the logits before sampling, lower is more predictable, the default is {}'.format(DEFAULT_TEMPERATURE), type=float, default=DEFAULT_TEMPERATURE)
+parser.add_argument('--top_k', help='Only sample from the k most likely tokens, the default 0 samples from all of them', type=int, default=0)
 parser.add_argument('--lines', help='The number of lines to generate, the default is 1', type=int, choices=range(1,21), default=1)
 
 
@@ -34,9 +53,12 @@ def newline_token(lang):
         return programtokenizer.word_to_token['\n']
 
 
-def generate_text(model, language, start_string, num_lines, index_to_token, var_char_index):
+def tokenize_seed(language, start_string, var_char_index, single_pass=False):
     if language.lower() == 'c':
         start_string, variable_to_token = programtokenizer.tokenize_c(start_string, var_char_index)
+    elif language.lower() in 'python' and single_pass:
+        stream_tokenizer = programtokenizer.StreamTokenizer(programtokenizer.word_to_token, var_char_index)
+        start_string, variable_to_token = stream_tokenizer.tokenize(start_string)
     elif language.lower() in 'python':
         # Evaluation step (generating text using the learned model)
         name_tokenizer = programtokenizer.NameTokenizer(var_char_index)
@@ -44,50 +66,10 @@ def generate_text(model, language, start_string, num_lines, index_to_token, var_
         start_string = programtokenizer.SyntaxTokenizer(programtokenizer.word_to_token).tokenize(start_string)
     else:
         sys.exit(1)
-
-    # Converting our start string to numbers (vectorizing)
-    token_to_index = {t: i for i, t in index_to_token.items()}
-
-    input_eval = [index_to_token[s] for s in start_string]
-    input_eval = tf.expand_dims(input_eval, 0)
-
-    # Empty string to store our results
-    text_generated = []
-
-    # Low temperatures results in more predictable text.
-    # Higher temperatures results in more surprising text.
-    # Experiment to find the best setting.
-    temperature = 1.0
-
-    # Here batch size == 1
-    model.reset_states()
-
-    new_lines = 0
-
-    generated_line = ''
-    while new_lines != num_lines:
-        predictions = model(input_eval)
-        # remove the batch dimension
-        predictions = tf.squeeze(predictions, 0)
-
-        # using a categorical distribution to predict the word returned by the model
-        predictions = predictions / temperature
-        predicted_id = tf.random.categorical(predictions, num_samples=1)[-1, 0].numpy()
-
-        # We pass the predicted word as the next input to the model
-        # along with the previous hidden state
-        input_eval = tf.expand_dims([predicted_id], 0)
-
-        generated_character = token_to_index[predicted_id]
-        generated_line += generated_character
-
-        if generated_character == newline_token(language) or len(generated_line) > 100:
-            if generated_line.strip() != '':
-                new_lines += 1
-                text_generated.append(generated_line)
-            generated_line = ''
+    return start_string, variable_to_token
 
 
+def untokenize_output(language, start_string, text_generated, variable_to_token):
     if language.lower() == 'c':
         whole_output = programtokenizer.untokenize_c(start_string + ''.join(text_generated), {v: k for k, v in variable_to_token.items()})
         tempid = str(uuid.uuid4())
@@ -111,6 +93,174 @@ def generate_text(model, language, start_string, num_lines, index_to_token, var_
     return whole_output, just_generated_lines.split('\n') + ['','','','']
 
 
+class LineTracker:
+    # Collects the generated tokens of one row into lines, a row is done once it has num_lines non blank lines
+    def __init__(self, language, num_lines):
+        self.newline = newline_token(language)
+        self.num_lines = num_lines
+        self.text_generated = []
+        self.generated_line = ''
+
+    def is_done(self):
+        return len(self.text_generated) == self.num_lines
+
+    def add(self, generated_character):
+        self.generated_line += generated_character
+        if generated_character == self.newline or len(self.generated_line) > MAX_LINE_LENGTH:
+            if self.generated_line.strip() != '':
+                self.text_generated.append(self.generated_line)
+            self.generated_line = ''
+
+
+def generate_text(decoder, language, start_string, num_lines, index_to_token, var_char_index, single_pass=False, prefix_cache=None,
+                  temperature=DEFAULT_TEMPERATURE, top_k=0):
+    result = generate_text_batch(decoder, language, [start_string], num_lines, index_to_token, var_char_index, single_pass,
+                                 prefix_cache, temperature, top_k)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def prime_seeds(decoder, rows, prefix_cache=None):
+    # Runs every row of token ids through the model from its longest cached prefix, returns the stacked states.
+    # Rows are run in chunks which end on multiples of the cache interval, so rows at different positions can share a
+    # call and the states at those positions can be cached.
+    interval = prefix_cache.interval if prefix_cache else prefixcache.CACHE_INTERVAL
+    initial_state = decoder.get_initial_state(1)
+    positions = [0] * len(rows)
+    states = [initial_state] * len(rows)
+    if prefix_cache:
+        for i, row in enumerate(rows):
+            positions[i], state = prefix_cache.get_longest_prefix(row)
+            states[i] = initial_state if state is None else state
+
+    remaining = [i for i, row in enumerate(rows) if positions[i] < len(row)]
+    while remaining:
+        chunks = collections.defaultdict(list)
+        for i in remaining:
+            chunks[min(interval - positions[i] % interval, len(rows[i]) - positions[i])].append(i)
+        for length, chunk_rows in chunks.items():
+            token_ids = np.array([rows[i][positions[i]:positions[i] + length] for i in chunk_rows], np.int32)
+            chunk_state = tuple(np.concatenate([states[i][part] for i in chunk_rows]) for part in range(2))
+            _, chunk_state = decoder.prime(token_ids, chunk_state)
+            for j, i in enumerate(chunk_rows):
+                states[i] = (chunk_state[0][j:j + 1], chunk_state[1][j:j + 1])
+                positions[i] += length
+                if prefix_cache and positions[i] % interval == 0:
+                    prefix_cache.put(rows[i][:positions[i]], states[i])
+        remaining = [i for i in remaining if positions[i] < len(rows[i])]
+    return tuple(np.concatenate([state[part] for state in states]) for part in range(2))
+
+
+def tokenize_seeds(language, start_strings, index_to_token, var_char_index, single_pass=False):
+    # A (tokenized, variable_to_token, token ids) triple per seed, or the exception raised for seeds which failed
+    seeds = []
+    for start_string in start_strings:
+        try:
+            start_string, variable_to_token = tokenize_seed(language, start_string, var_char_index, single_pass)
+            seeds.append((start_string, variable_to_token, [index_to_token[s] for s in start_string]))
+        except Exception as e:
+            seeds.append(e)
+    return seeds
+
+
+def decode_lines(decoder, decoder_state, predicted_ids, trackers, active, token_to_index, temperature=DEFAULT_TEMPERATURE, top_k=0):
+    # Samples for every row in lockstep until the active rows' trackers are done, returns the log probability of each
+    # row's generated tokens
+    log_probs = np.zeros(len(trackers))
+    while active:
+        # We pass the predicted words as the next input to the model
+        # along with the previous hidden state
+        predicted_ids, step_log_probs, decoder_state = decoder.sample(predicted_ids, decoder_state, temperature, top_k)
+        for i in active:
+            trackers[i].add(token_to_index[predicted_ids[i]])
+            log_probs[i] += step_log_probs[i]
+        active = [i for i in active if not trackers[i].is_done()]
+    return log_probs
+
+
+def generate_text_batch(decoder, language, start_strings, num_lines, index_to_token, var_char_index, single_pass=False,
+                        prefix_cache=None, temperature=DEFAULT_TEMPERATURE, top_k=0):
+    # Generates num_lines lines for every seed in lockstep, reusing the states in prefix_cache for seed prefixes seen before.
+    # Returns a (whole_output, generated_lines) pair per seed, or the exception raised for seeds which failed.
+    token_to_index = {t: i for i, t in index_to_token.items()}
+    newline_index = index_to_token[newline_token(language)]
+    seeds = tokenize_seeds(language, start_strings, index_to_token, var_char_index, single_pass)
+
+    # Everything but the last seed token is primed, the last one is the first input to the decode loop. Failed and
+    # empty seeds are a newline, they are decoded but never read.
+    rows = [seed[2] if not isinstance(seed, Exception) and seed[2] else [newline_index] for seed in seeds]
+    decoder_state = prime_seeds(decoder, [row[:-1] for row in rows], prefix_cache)
+
+    trackers = [LineTracker(language, num_lines) for _ in rows]
+    active = [i for i, seed in enumerate(seeds) if not isinstance(seed, Exception)]
+    decode_lines(decoder, decoder_state, np.array([row[-1] for row in rows], np.int32), trackers, active,
+                 token_to_index, temperature, top_k)
+
+    results = []
+    for seed, tracker in zip(seeds, trackers):
+        if isinstance(seed, Exception):
+            results.append(seed)
+            continue
+        try:
+            results.append(untokenize_output(language, seed[0], tracker.text_generated, seed[1]))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def generate_text_best_of(decoder, language, start_string, num_lines, index_to_token, var_char_index, num_samples,
+                          single_pass=False, prefix_cache=None, temperature=DEFAULT_TEMPERATURE, top_k=0):
+    # Primes the seed once and samples num_samples continuations of it together. Returns (whole_output,
+    # generated_lines, log_probability) triples, most likely first. Candidates which can't be untokenized are dropped.
+    token_to_index = {t: i for i, t in index_to_token.items()}
+    seed = tokenize_seeds(language, [start_string], index_to_token, var_char_index, single_pass)[0]
+    if isinstance(seed, Exception):
+        raise seed
+    row = seed[2] or [index_to_token[newline_token(language)]]
+
+    decoder_state = prime_seeds(decoder, [row[:-1]], prefix_cache)
+    decoder_state = tuple(np.repeat(part, num_samples, axis=0) for part in decoder_state)
+
+    trackers = [LineTracker(language, num_lines) for _ in range(num_samples)]
+    log_probs = decode_lines(decoder, decoder_state, np.full(num_samples, row[-1], np.int32), trackers,
+                             list(range(num_samples)), token_to_index, temperature, top_k)
+
+    candidates = []
+    for tracker, log_prob in zip(trackers, log_probs):
+        try:
+            candidates.append(untokenize_output(language, seed[0], tracker.text_generated, seed[1]) + (float(log_prob),))
+        except Exception:
+            pass
+    return sorted(candidates, key=lambda candidate: candidate[2], reverse=True)
+
+
+def load_decoder(checkpoint_dir, vocab_size, use_tensorflow=False):
+    # Tensorflow is only imported when asked for, or to export the weights of a new checkpoint for numpy
+    config = modelconfig.read_checkpoint_config(checkpoint_dir)
+    if use_tensorflow:
+        import decoder
+        import model_maker
+        return decoder.Decoder(model_maker.load_inference_model(config, vocab_size, checkpoint_dir))
+    if not numpydecoder.is_exported(checkpoint_dir):
+        import decoder
+        print('Exporting the weights of the latest checkpoint...', file=sys.stderr)
+        decoder.export_weights(config, vocab_size, checkpoint_dir)
+    return numpydecoder.NumpyDecoder(os.path.join(checkpoint_dir, numpydecoder.WEIGHTS_FILE))
+
+
+def candidates_record(prompt, candidates):
+    # The json record of generate_text_best_of's candidates, best first
+    return {'prompt': prompt, 'candidates': [{'output': output, 'generated_lines': generated_lines, 'log_probability': log_prob}
+                                             for output, generated_lines, log_prob in candidates]}
+
+
+def read_prompts(prompts_path):
+    # A json object per line with the seed program under "prompt"
+    with open(prompts_path, encoding='utf8') as f:
+        return [json.loads(line)['prompt'] for line in f if line.strip()]
+
+
 # MAIN #
 
 
@@ -125,33 +275,64 @@ if __name__ == '__main__':
     num_lines = args.lines
     gen_start_string = ''
 
+    # Read input
+    if len([i for i in (input_dir, console_input, args.Jin) if i]) > 1:
+        parser.error('Please specify only one of --Fin, --Cin and --Jin')
+
+    if args.Jin:
+        print('Taking prompts from file {}'.format(args.Jin), file=sys.stderr)
+        prompts = read_prompts(args.Jin)
+    elif input_dir:
+        print('Taking input from file {}'.format(input_dir), file=sys.stderr)
+        with open(input_dir, 'r') as f:
+            gen_start_string = f.read()
+    elif console_input:
+        gen_start_string = console_input
+    else:
+        parser.error('No input method specified')
+
     # Build the model
-    with open(os.path.join(checkpoint_dir, train.WORD_TO_INDEX_FILE)) as json_file:
+    with open(os.path.join(checkpoint_dir, modelconfig.WORD_TO_INDEX_FILE)) as json_file:
         state = json.load(json_file)
 
-        model = model_maker.build_model(int(state['vocab_size']), model_maker.EMBEDDING_DIMENSION, model_maker.RNN_UNITS, batch_size=1)
-        model.load_weights(tf.train.latest_checkpoint(checkpoint_dir))
-        model.build(tf.TensorShape([1, None]))
-
-        # Read input
-        if input_dir and console_input:
-            parser.error('Please specify either --Fin or --Cin, not both')
-
-        if input_dir:
-            print('Taking input from file {}'.format(input_dir))
-            with open(input_dir, 'r') as f:
-                gen_start_string = f.read()
-        elif console_input:
-            gen_start_string = console_input
-        else:
-            parser.error('No input method specified')
-
-        # Generate output
-        generated_text = generate_text(model, language, gen_start_string, num_lines, state['index_to_token'], state['variable_char_start'])
-
-        if output_dir:
-            print("Outputting to file {}".format(output_dir))
-            with open(output_dir, 'w') as f:
-                f.write(generated_text)
-        else:
-            print(generated_text)
+    decoder = load_decoder(checkpoint_dir, int(state['vocab_size']), args.tensorflow)
+
+    if args.samples < 1:
+        parser.error('--samples must be at least 1')
+
+    if args.Jin:
+        # Generate output, a batch of prompts at a time, or every sample of one prompt at a time
+        # Prompts often share prefixes, e.g. several edits of the same program
+        prefix_cache = prefixcache.PrefixStateCache()
+        with open(output_dir, 'w', encoding='utf8') if output_dir else sys.stdout as f:
+            for batch in it.chunks(prompts, args.batch_size if args.samples == 1 else 1):
+                if args.samples == 1:
+                    results = generate_text_batch(decoder, language, batch, num_lines, state['index_to_token'], state['variable_char_start'], state.get('single_pass_tokenizer', False), prefix_cache, args.temperature, args.top_k)
+                else:
+                    try:
+                        results = [generate_text_best_of(decoder, language, batch[0], num_lines, state['index_to_token'], state['variable_char_start'], args.samples, state.get('single_pass_tokenizer', False), prefix_cache, args.temperature, args.top_k)]
+                    except Exception as e:
+                        results = [e]
+                for prompt, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        record = {'prompt': prompt, 'error': str(result)}
+                    elif args.samples == 1:
+                        record = {'prompt': prompt, 'output': result[0], 'generated_lines': result[1]}
+                    else:
+                        record = candidates_record(prompt, result)
+                    f.write(json.dumps(record) + '\n')
+        sys.exit(0)
+
+    # Generate output, the candidates are written as a json record like the ones --Jin writes
+    if args.samples == 1:
+        generated_text, _ = generate_text(decoder, language, gen_start_string, num_lines, state['index_to_token'], state['variable_char_start'], state.get('single_pass_tokenizer', False), temperature=args.temperature, top_k=args.top_k)
+    else:
+        candidates = generate_text_best_of(decoder, language, gen_start_string, num_lines, state['index_to_token'], state['variable_char_start'], args.samples, state.get('single_pass_tokenizer', False), temperature=args.temperature, top_k=args.top_k)
+        generated_text = json.dumps(candidates_record(gen_start_string, candidates))
+
+    if output_dir:
+        print("Outputting to file {}".format(output_dir))
+        with open(output_dir, 'w') as f:
+            f.write(generated_text)
+    else:
+        print(generated_text)
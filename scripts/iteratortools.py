@@ -10,10 +10,23 @@
 
 import os
 import datetime
-from threading import Lock
 from multiprocessing.dummy import Pool as ThreadPool
 import multiprocessing
+import functools
 import csv
+import sqlite3
+import hashlib
+import json
+import sys
+import time
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, parallel runs then rely on the unique temp file alone
+    fcntl = None
 
 
 # CONSTANTS #
@@ -36,9 +49,105 @@ TRAINING_SET_FILE_PATHS_CODE_CHEF = [
     os.path.join(DATA_PATH_CODE_CHEF, "program_codes", "second.csv"),
     os.path.join(DATA_PATH_CODE_CHEF, "program_codes", "third.csv")
 ]
+CORPUS_DB_PATH = os.path.join(DATA_PATH_CODE_CHEF, 'corpus.sqlite')
+SPLIT_MANIFEST_PATH = os.path.join(DATA_PATH_CODE_CHEF, 'split_manifest.csv')
 
+SPLIT_BUCKETS = 100
 
-def get_lang_files(language, training_only=False, evaluation_only=False, training_portion=0.7):
+THREAD_BACKEND = 'thread'
+PROCESS_BACKEND = 'process'
+DISPATCH_CHUNK_SIZE = 16
+
+
+def corpus_is_stale():
+    if not os.path.exists(CORPUS_DB_PATH) or not os.path.exists(SPLIT_MANIFEST_PATH):
+        return True
+    built = os.path.getmtime(CORPUS_DB_PATH)
+    return any(os.path.getmtime(path) > built for path in [SOLUTION_PATH_CODE_CHEF] + TRAINING_SET_FILE_PATHS_CODE_CHEF)
+
+
+def split_bucket(solution_id):
+    # Stable across runs and csv orderings, unlike slicing the loaded list
+    return int(hashlib.md5(solution_id.encode('utf-8')).hexdigest(), 16) % SPLIT_BUCKETS
+
+
+def update_split_manifest(connection):
+    # Existing assignments are never changed, new solutions are appended with their hashed bucket
+    connection.execute('CREATE TABLE split_manifest (solution_id TEXT PRIMARY KEY, bucket INTEGER)')
+    if os.path.exists(SPLIT_MANIFEST_PATH):
+        with open(SPLIT_MANIFEST_PATH, 'r', newline='') as f:
+            connection.executemany('INSERT OR IGNORE INTO split_manifest VALUES (?, ?)', csv.reader(f))
+
+    new_ids = [row[0] for row in connection.execute(
+        'SELECT DISTINCT solution_id FROM solutions WHERE solution_id NOT IN (SELECT solution_id FROM split_manifest)'
+    )]
+    assignments = [(solution_id, split_bucket(solution_id)) for solution_id in new_ids]
+    connection.executemany('INSERT INTO split_manifest VALUES (?, ?)', assignments)
+    with open(SPLIT_MANIFEST_PATH, 'a', newline='') as f:
+        csv.writer(f).writerows(assignments)
+
+
+def build_corpus_index():
+    # One-time ingest of the CodeChef csvs into an indexed SQLite store so later runs only read the programs they need
+    # A temp file per process, so parallel runs never build into or replace each other's
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(CORPUS_DB_PATH))
+    os.close(fd)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute('CREATE TABLE solutions (seq INTEGER PRIMARY KEY, solution_id TEXT, language TEXT, verdict TEXT)')
+        connection.execute('CREATE TABLE programs (solution_id TEXT PRIMARY KEY, code TEXT)')
+
+        print('Indexing solutions...')
+        with open(SOLUTION_PATH_CODE_CHEF, 'r') as f:
+            reader = csv.reader(f)
+            connection.executemany(
+                'INSERT INTO solutions (solution_id, language, verdict) VALUES (?, ?, ?)',
+                ((row[1], row[7].lower(), row[4]) for row in reader)
+            )
+
+        for soltn_file in TRAINING_SET_FILE_PATHS_CODE_CHEF:
+            print('Indexing {}...'.format(os.path.basename(soltn_file)))
+            with open(soltn_file, 'r', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                connection.executemany(
+                    'INSERT OR REPLACE INTO programs (solution_id, code) VALUES (?, ?)',
+                    ((row[0], row[1]) for row in reader)
+                )
+
+        connection.execute('CREATE INDEX solutions_language_verdict ON solutions (language, verdict)')
+        update_split_manifest(connection)
+        connection.commit()
+    except BaseException:
+        connection.close()
+        os.remove(temp_path)
+        raise
+    connection.close()
+    os.replace(temp_path, CORPUS_DB_PATH)
+
+
+@contextlib.contextmanager
+def corpus_build_lock():
+    if fcntl is None:
+        yield
+        return
+    with open(CORPUS_DB_PATH + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_corpus():
+    if corpus_is_stale():
+        with corpus_build_lock():
+            # Another process may have rebuilt it while we waited for the lock
+            if corpus_is_stale():
+                build_corpus_index()
+    return sqlite3.connect(CORPUS_DB_PATH)
+
+
+def iter_lang_files(language, training_only=False, evaluation_only=False, training_portion=0.7):
 
     if training_only and evaluation_only:
         raise SystemError('Only allowed training or evaluation, pick one!')
@@ -46,35 +155,30 @@ def get_lang_files(language, training_only=False, evaluation_only=False, trainin
     if language == 'python' or language == 'py':
         language = 'pyth'
 
-    ids = []
-    with open(SOLUTION_PATH_CODE_CHEF, 'r') as f:
-        reader = csv.reader(f)
-        no_of_c = 0
-        total = 0
-        for row in reader:
-            total += 1
-            if row[7].lower() == language and row[4] != 'wrong answer':
-                ids.append(row[1])
-                no_of_c += 1
-    soltn_dict = {}
-    for soltn_file in TRAINING_SET_FILE_PATHS_CODE_CHEF:
-        with open(soltn_file, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                soltn_dict[row[0]] = row[1]
-    lang_only = []
-    errors = 0
-    for id in ids:
-        try:
-            lang_only.append(soltn_dict[id])
-        except KeyError:
-            errors += 1
-    print(len(lang_only))
-
+    query = 'SELECT programs.code FROM solutions ' \
+            'JOIN programs ON programs.solution_id = solutions.solution_id ' \
+            'JOIN split_manifest ON split_manifest.solution_id = solutions.solution_id ' \
+            'WHERE solutions.language = ? AND solutions.verdict != ?'
+    params = [language, 'wrong answer']
     if training_only:
-        return lang_only[:int(len(lang_only) * training_portion)]
+        query += ' AND split_manifest.bucket < ?'
+        params.append(int(round(training_portion * SPLIT_BUCKETS)))
     if evaluation_only:
-        return lang_only[int(len(lang_only) * training_portion):]
+        query += ' AND split_manifest.bucket >= ?'
+        params.append(int(round(training_portion * SPLIT_BUCKETS)))
+    query += ' ORDER BY solutions.seq'
+
+    connection = open_corpus()
+    try:
+        for (code,) in connection.execute(query, params):
+            yield code
+    finally:
+        connection.close()
+
+
+def get_lang_files(language, training_only=False, evaluation_only=False, training_portion=0.7):
+    lang_only = list(iter_lang_files(language, training_only, evaluation_only, training_portion))
+    print(len(lang_only))
     return lang_only
 
 
@@ -124,34 +228,70 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
-def iterate(task, error_file_path, content, proportion=0, chunk_size=1):
+def run_task(task, file):
+    # Runs in the worker, failures are sent back to the parent rather than logged from every worker
+    try:
+        task(file)
+        return file, None
+    except Exception as e:
+        return file, str(e)
+
+
+def read_journal(journal_file_path):
+    if journal_file_path is None or not os.path.exists(journal_file_path):
+        return set()
+    with open(journal_file_path, 'r', encoding='utf8') as f:
+        return set(line.rstrip('\n') for line in f)
+
+
+def iterate(task, error_file_path, content, proportion=0, chunk_size=1, backend=THREAD_BACKEND, dispatch_chunk_size=DISPATCH_CHUNK_SIZE, journal_file_path=None):
+    # Use PROCESS_BACKEND for CPU bound tasks, these must then be picklable (i.e. module level functions)
+    # With a journal, every finished item is appended to it and skipped when the run is restarted. The journal is
+    # removed once a run finishes without errors, otherwise the next run only retries the items which failed.
+    completed = read_journal(journal_file_path)
+    remaining = [file for file in content if str(file) not in completed]
+    if len(remaining) < len(content):
+        print('Skipping {} items already done according to {}'.format(len(content) - len(remaining), journal_file_path))
+
     total = content.__len__() / chunk_size
-    progress_bar = ProgressBar(total * proportion, total, prefix='Progress:', suffix='Complete')
+    progress_bar = ProgressBar(total * proportion + (len(content) - len(remaining)) / chunk_size, total, prefix='Progress:', suffix='Complete')
     progress_bar.print_progress_bar()
 
-    error_file_lock = Lock()
-    increment_work_lock = Lock()
-    increment_errors_lock = Lock()
-
-    def an_iteration(file):
-        try:
-            task(file)
-        except Exception as e:
-            with increment_errors_lock:
-                progress_bar.increment_errors()
-            with error_file_lock:
-                handle_exception(error_file_path, file, 'Error in doing thing', e)
-        finally:
-            with increment_work_lock:
+    if backend == PROCESS_BACKEND:
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    elif backend == THREAD_BACKEND:
+        pool = ThreadPool(multiprocessing.cpu_count())
+    else:
+        raise ValueError('Unknown backend {}, pick one of {}'.format(backend, [THREAD_BACKEND, PROCESS_BACKEND]))
+
+    journal = None
+    if journal_file_path:
+        # A bare file name is in the working directory, which already exists
+        if os.path.dirname(journal_file_path):
+            os.makedirs(os.path.dirname(journal_file_path), exist_ok=True)
+        journal = open(journal_file_path, 'a', encoding='utf8')
+    try:
+        with pool:
+            for file, error in pool.imap_unordered(functools.partial(run_task, task), remaining, dispatch_chunk_size):
+                if error is not None:
+                    progress_bar.increment_errors()
+                    handle_exception(error_file_path, file, 'Error in doing thing', error)
+                elif journal:
+                    journal.write(str(file) + '\n')
+                    journal.flush()
                 progress_bar.increment_work()
                 progress_bar.print_progress_bar()
-
-    pool = multiprocessing.dummy.Pool(multiprocessing.cpu_count())
-    pool.map(an_iteration, content)
+    finally:
+        if journal:
+            journal.close()
+    if journal and not progress_bar.errors:
+        os.remove(journal_file_path)
 
 
 class ProgressBar:
-    def __init__(self, iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█'):
+    # Updates are plain counter increments, rendering is rate limited so it is cheap to call print_progress_bar per item.
+    # When not attached to a terminal a JSON progress line is written every log_interval seconds instead of the bar.
+    def __init__(self, iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', max_renders_per_second=10, log_interval=30, stream=None):
         self.iteration = iteration
         self.total = total
         self.prefix = prefix
@@ -160,6 +300,13 @@ class ProgressBar:
         self.length = length
         self.fill = fill
         self.errors = 0
+        self.stream = stream or sys.stdout
+        self.is_tty = self.stream.isatty()
+        self.render_interval = 1.0 / max_renders_per_second if self.is_tty else log_interval
+        self.start_iteration = iteration
+        self.start_time = time.monotonic()
+        self.last_render_time = None
+        self.finished = False
 
     def increment_work(self, work_num=1):
         self.iteration += work_num
@@ -167,11 +314,51 @@ class ProgressBar:
     def increment_errors(self, error_num=1):
         self.errors += error_num
 
-    def print_progress_bar(self):
-        percent = ("{0:." + str(self.decimals) + "f}").format(100 * (self.iteration / float(self.total)))
-        filled_length = int(self.length * self.iteration // self.total)
+    def get_rate(self):
+        elapsed = time.monotonic() - self.start_time
+        return (self.iteration - self.start_iteration) / elapsed if elapsed > 0 else 0.0
+
+    def get_eta(self):
+        rate = self.get_rate()
+        return (self.total - self.iteration) / rate if rate > 0 else None
+
+    def print_progress_bar(self, force=False):
+        if self.finished and not force:
+            return
+        now = time.monotonic()
+        finished = self.iteration >= self.total
+        if not force and not finished and self.last_render_time is not None and now - self.last_render_time < self.render_interval:
+            return
+        self.last_render_time = now
+        self.finished = finished
+
+        if self.is_tty:
+            self.print_bar()
+        else:
+            self.print_log_line()
+
+    def print_bar(self):
+        fraction = min(self.iteration / float(self.total), 1.0) if self.total else 1.0
+        percent = ("{0:." + str(self.decimals) + "f}").format(100 * fraction)
+        filled_length = int(self.length * fraction)
         bar = self.fill * filled_length + '-' * (self.length - filled_length)
-        print('%s |%s| %s%% (%s/%s) %s, %s %s' % (self.prefix, bar, percent, self.iteration, self.total, self.suffix, str(self.errors), 'errors'), end='\r')
+        eta = self.get_eta()
+        eta = str(datetime.timedelta(seconds=int(eta))) if eta is not None else '?'
+        self.stream.write('\r%s |%s| %s%% (%s/%s) %s, %s %s, %.1f it/s, ETA %s' % (self.prefix, bar, percent, self.iteration, self.total, self.suffix, str(self.errors), 'errors', self.get_rate(), eta))
         # Print New Line on Complete
-        if self.iteration == self.total:
-            print()
+        if self.finished:
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def print_log_line(self):
+        eta = self.get_eta()
+        self.stream.write(json.dumps({
+            'time': str(datetime.datetime.now()),
+            'prefix': self.prefix,
+            'done': self.iteration,
+            'total': self.total,
+            'errors': self.errors,
+            'rate': round(self.get_rate(), 3),
+            'eta_seconds': round(eta, 1) if eta is not None else None
+        }) + '\n')
+        self.stream.flush()
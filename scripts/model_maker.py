@@ -1,12 +1,6 @@
 import tensorflow as tf
 
 
-# CONSTANTS #
-
-EMBEDDING_DIMENSION = 256
-RNN_UNITS = 1024
-
-
 # FUNCTIONS #
 
 
@@ -17,4 +11,36 @@ def build_model(vocab_size, embedding_dim, rnn_units, batch_size):
         tf.keras.layers.Dense(vocab_size)
     ])
     
-    return model
\ No newline at end of file
+    return model
+
+
+def build_model_from_config(config, vocab_size, batch_size=None):
+    # batch_size defaults to the training batch size, inference builds with its own
+    return build_model(
+        vocab_size=vocab_size,
+        embedding_dim=config['embedding_dimension'],
+        rnn_units=config['rnn_units'],
+        batch_size=config['batch_size'] if batch_size is None else batch_size
+    )
+
+
+def build_inference_model(vocab_size, embedding_dim, rnn_units):
+    # Not stateful, the LSTM state is an input and an output so decoding can run any batch size from any state.
+    # The weights are laid out the same as build_model's.
+    tokens = tf.keras.Input(shape=(None,), dtype='int32')
+    state_h = tf.keras.Input(shape=(rnn_units,))
+    state_c = tf.keras.Input(shape=(rnn_units,))
+    embedded = tf.keras.layers.Embedding(vocab_size, embedding_dim)(tokens)
+    outputs, output_h, output_c = tf.keras.layers.LSTM(rnn_units, return_sequences=True, return_state=True)(
+        embedded, initial_state=[state_h, state_c])
+    logits = tf.keras.layers.Dense(vocab_size)(outputs)
+    return tf.keras.Model(inputs=[tokens, state_h, state_c], outputs=[logits, output_h, output_c])
+
+
+def load_inference_model(config, vocab_size, checkpoint_dir):
+    # The checkpoints are of the training model, so they are loaded into that and the weights copied across
+    model = build_model_from_config(config, vocab_size, batch_size=1)
+    model.load_weights(tf.train.latest_checkpoint(checkpoint_dir))
+    inference_model = build_inference_model(vocab_size, config['embedding_dimension'], config['rnn_units'])
+    inference_model.set_weights(model.get_weights())
+    return inference_model
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+
+# This script is used for reading and writing the model and training hyperparameters shared by training and inference.
+# It does not import tensorflow, so inference can read a checkpoint directory without it.
+
+
+# IMPORTS #
+
+
+import json
+import os
+
+
+# CONSTANTS #
+
+
+CONFIG_FILE = 'model_config.json'
+WORD_TO_INDEX_FILE = 'word_to_index.json'
+
+DEFAULT_CONFIG = {
+    'embedding_dimension': 256,
+    'rnn_units': 1024,
+    'batch_size': 64,
+    'seq_length': 100,
+    'epochs': 10
+}
+
+
+# FUNCTIONS #
+
+
+def load_config(config_path=None, **overrides):
+    # Defaults, then the values in config_path, then any overrides which are not None
+    config = dict(DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path) as fp:
+            config.update(json.load(fp))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown config options {}, expected some of {}'.format(sorted(unknown), sorted(DEFAULT_CONFIG)))
+    return config
+
+
+def write_config(config, checkpoint_dir):
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    with open(os.path.join(checkpoint_dir, CONFIG_FILE), 'w') as fp:
+        json.dump(config, fp, indent=4)
+
+
+def read_checkpoint_config(checkpoint_dir):
+    # Checkpoints from before the config file was written were all trained with the defaults
+    config_path = os.path.join(checkpoint_dir, CONFIG_FILE)
+    return load_config(config_path if os.path.exists(config_path) else None)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+
+# This script is used for running a trained model in numpy from weights exported by decoder.export_weights, so
+# generation can start without importing tensorflow. It has the same interface as decoder.Decoder.
+
+
+# IMPORTS #
+
+
+import numpy as np
+import os
+import re
+
+
+# CONSTANTS #
+
+
+WEIGHTS_FILE = 'weights.npz'
+CHECKPOINT_STATE_FILE = 'checkpoint'
+
+
+# FUNCTIONS #
+
+
+def get_latest_checkpoint_name(checkpoint_dir):
+    # The same checkpoint tf.train.latest_checkpoint finds, read from the checkpoint state file directly
+    state_path = os.path.join(checkpoint_dir, CHECKPOINT_STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        match = re.search(r'^model_checkpoint_path: "(.*)"$', f.read(), re.MULTILINE)
+    return os.path.basename(match.group(1)) if match else None
+
+
+def is_exported(checkpoint_dir):
+    # Whether the exported weights are of the latest checkpoint
+    weights_path = os.path.join(checkpoint_dir, WEIGHTS_FILE)
+    if not os.path.exists(weights_path):
+        return False
+    with np.load(weights_path) as weights:
+        return str(weights['checkpoint']) == get_latest_checkpoint_name(checkpoint_dir)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+class NumpyDecoder:
+    # States are (h, c) pairs of (batch, rnn_units) arrays
+    def __init__(self, weights_path):
+        with np.load(weights_path) as weights:
+            self.embedding = weights['embedding']
+            self.kernel = weights['kernel']
+            self.recurrent_kernel = weights['recurrent_kernel']
+            self.bias = weights['bias']
+            self.dense_kernel = weights['dense_kernel']
+            self.dense_bias = weights['dense_bias']
+        self.rnn_units = self.recurrent_kernel.shape[0]
+
+    def lstm_step(self, inputs, state):
+        # inputs is the embedding already multiplied by the kernel plus the bias. Keras' gate order is input, forget,
+        # cell, output, with a sigmoid recurrent activation.
+        state_h, state_c = state
+        z = inputs + state_h.dot(self.recurrent_kernel)
+        i, f, c, o = np.split(z, 4, axis=-1)
+        state_c = sigmoid(f) * state_c + sigmoid(i) * np.tanh(c)
+        state_h = sigmoid(o) * np.tanh(state_c)
+        return state_h, state_c
+
+    def get_logits(self, state_h):
+        return state_h.dot(self.dense_kernel) + self.dense_bias
+
+    def get_initial_state(self, batch_size):
+        return np.zeros((batch_size, self.rnn_units), np.float32), np.zeros((batch_size, self.rnn_units), np.float32)
+
+    def prime(self, token_ids, state):
+        # Runs (batch, length) token ids through the model, returns the logits after the last one and the new state
+        inputs = self.embedding[np.asarray(token_ids)].dot(self.kernel) + self.bias
+        for step in range(inputs.shape[1]):
+            state = self.lstm_step(inputs[:, step], state)
+        return self.get_logits(state[0]), state
+
+    def sample(self, token_ids, state, temperature=1.0, top_k=0):
+        # Feeds one token per row and samples the next, returns the sampled ids, their log probabilities and the new state
+        state = self.lstm_step(self.embedding[np.asarray(token_ids)].dot(self.kernel) + self.bias, state)
+        log_probs = log_softmax(self.get_logits(state[0]))
+        sampling_log_probs = log_probs / temperature
+        if 0 < top_k < log_probs.shape[1]:
+            # Only the top_k most likely tokens can be sampled
+            threshold = np.partition(log_probs, -top_k, axis=-1)[:, -top_k:].min(axis=-1, keepdims=True)
+            sampling_log_probs = np.where(log_probs < threshold, -np.inf, sampling_log_probs)
+        # using a categorical distribution to predict the word returned by the model
+        cumulative = np.cumsum(np.exp(log_softmax(sampling_log_probs)), axis=-1)
+        uniform = np.random.random_sample((len(cumulative), 1)) * cumulative[:, -1:]
+        sampled_ids = np.minimum((cumulative < uniform).sum(axis=-1), cumulative.shape[1] - 1)
+        return sampled_ids, log_probs[np.arange(len(sampled_ids)), sampled_ids], state
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+
+# This script is used for caching the LSTM state after a tokenized program prefix, so generating from a seed which
+# shares a prefix with an earlier one only has to run the model over the rest of it.
+
+
+# IMPORTS #
+
+
+import numpy as np
+import collections
+import hashlib
+
+
+# CONSTANTS #
+
+
+# States are only cached at prefix lengths which are multiples of this, so looking up the longest cached prefix
+# doesn't have to hash every prefix of a seed
+CACHE_INTERVAL = 64
+MAX_CACHE_BYTES = 256 * 1024 ** 2
+
+
+# FUNCTIONS #
+
+
+def prefix_key(token_ids):
+    return hashlib.sha1(np.asarray(token_ids, np.int32).tobytes()).hexdigest()
+
+
+class PrefixStateCache:
+    # Least recently used states are evicted once the cached states take up more than max_bytes.
+    # A cache belongs to one model, states are (h, c) pairs of (1, rnn_units) arrays.
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, interval=CACHE_INTERVAL):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_longest_prefix(self, token_ids):
+        # Returns the length of the longest cached prefix of token_ids and the state after it, or (0, None)
+        for length in range(len(token_ids) // self.interval * self.interval, 0, -self.interval):
+            key = prefix_key(token_ids[:length])
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return length, self.entries[key]
+        self.misses += 1
+        return 0, None
+
+    def put(self, token_ids, state):
+        key = prefix_key(token_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        # Copied so a row's state doesn't keep the whole batch's arrays alive
+        state = tuple(np.array(s, copy=True) for s in state)
+        self.entries[key] = state
+        self.size += sum(s.nbytes for s in state)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(s.nbytes for s in evicted)
@@ -1,16 +1,23 @@
 import tokenize
+import keyword
 import re
 from io import BytesIO
 import ast
 import astunparse
 import clang.cindex
 import clang.enumerations
-import tempfile
+import threading
 import subprocess
+import sys
+import hashlib
+import json
 
 
 TOKEN_RANGE_START = 1286
 
+# Bump whenever a change to the tokenizers changes their output, this invalidates cached tokenizations
+TOKENIZER_VERSION = 1
+
 
 words = ['eof', 'if', '\n', '    ', 'for', 'while', ':', 'False', 'None', 'True', 'and', 'as', 'assert', 'break',
          'class', 'continue', 'def', 'del', 'elif', 'else', 'except', 'finally', 'from', 'global', 'import', 'in', 'is',
@@ -32,6 +39,16 @@ var_char_index = utf8char
 
 
 token_to_word = {v: k for k, v in word_to_token.items()}
+token_to_word_table = {ord(t): word for t, word in token_to_word.items()}
+
+class_re = re.compile(word_to_token['class'] + r'([\s\S]*?)' + word_to_token[':'] + word_to_token['\n'])
+def_re = re.compile(word_to_token['def'] + r'([\s\S]*?)' + word_to_token[':'] + word_to_token['\n'])
+unmapped_token_re = re.compile('[' + chr(TOKEN_RANGE_START) + '-' + chr(sys.maxunicode) + ']')
+
+
+def get_vocabulary_hash(language):
+    vocabulary = c_keywords if language.lower() == 'c' else words
+    return hashlib.sha256(json.dumps([TOKEN_RANGE_START, vocabulary]).encode('utf-8')).hexdigest()
 
 
 def get_var_char_index():
@@ -80,61 +97,162 @@ class SyntaxTokenizer:
         self.word_to_token = word_to_token
 
     def tokenize(self, program_as_string):
+        # Offset of the start of every line so token (row, col) positions can be turned into string indices
+        # (tokenize drops a leading byte order mark from the first line's columns)
+        line_offsets = [0, 1 if program_as_string.startswith('\ufeff') else 0]
+        newline_index = program_as_string.find('\n')
+        while newline_index != -1:
+            line_offsets.append(newline_index + 1)
+            newline_index = program_as_string.find('\n', newline_index + 1)
+
         str_index = 0
-        result = ''
-        g = tokenize.tokenize(BytesIO(program_as_string.encode('utf-8')).readline)
+        result = []
+        g = self.generate_tokens(program_as_string)
         in_class_or_def = False
-        for toknum, tokval, _, _, _ in g:
-            if toknum == 59:
+        for token_num, (toknum, tokval, (row, col), _, _) in enumerate(g):
+            if toknum == tokenize.ENCODING:
                 continue
             word_len = len(tokval)
 
-            substr = program_as_string[str_index:str_index + word_len]
-            spaces_num = 0
-            while substr != tokval:
-                result += program_as_string[str_index]
-                str_index += 1
-                substr = program_as_string[str_index:str_index + word_len]
-                spaces_num += 1
-                if spaces_num == 4:
-                    spaces_num = 0
-                    result = result[:-4]
-                    # result += word_to_token['    ']
+            # Empty tokens (dedents, end marker) are matched where the last token ended, not where they are reported
+            token_index = line_offsets[row] + col if word_len else str_index
+            if token_index > str_index:
+                # Whitespace before the token is kept except for whole groups of four characters
+                gap = program_as_string[str_index:token_index]
+                result.append(gap[len(gap) - len(gap) % 4:])
+                str_index = token_index
 
             if tokval == ':':
                 in_class_or_def = False
             if tokval == 'class' or tokval == 'def':
                 in_class_or_def = True
             if in_class_or_def and (tokval == '(' or tokval == ')' or tokval == ','):
-                result += ' '
+                result.append(' ')
                 str_index += 1
                 continue
 
             # TODO: remove the indenting token
             if toknum == tokenize.DEDENT:
-                result += self.word_to_token['dedent']
+                result.append(self.word_to_token['dedent'])
             elif toknum == tokenize.INDENT:
-                result += self.word_to_token['indent']
+                result.append(self.word_to_token['indent'])
             else:
-                try:
-                    result += self.word_to_token[tokval]
-                except KeyError:
-                    result += tokval
-                finally:
-                    str_index += word_len
+                result.append(self.substitute(token_num, tokval))
+                str_index += word_len
+
+        return ''.join(result)[:-1]  # all but last char which will always be a dedent
 
-        return result[:-1]  # all but last char which will always be a dedent
+    def generate_tokens(self, program_as_string):
+        return tokenize.tokenize(BytesIO(program_as_string.encode('utf-8')).readline)
 
+    def substitute(self, token_num, tokval):
+        return self.word_to_token.get(tokval, tokval)
 
-def tokenize_python(program_as_string):
+
+class StreamTokenizer(SyntaxTokenizer):
+    # Renames variables on the token stream instead of round tripping through ast/astunparse, so the program is only
+    # lexed once. Renamed are the NAME tokens ast would parse as ast.Name nodes, numbered in source order. The source
+    # formatting is kept rather than normalised by astunparse, so output differs from NameTokenizer + SyntaxTokenizer.
+    SKIPPED_TOKENS = {tokenize.ENCODING, tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT}
+    NAMELESS_STATEMENTS = {'import', 'from', 'global', 'nonlocal'}
+
+    def __init__(self, word_to_token, start_token):
+        super().__init__(word_to_token)
+        self.start_token = start_token
+        self.name_map = {}
+        self.variable_token_nums = set()
+
+    def tokenize(self, program_as_string):
+        self.name_map = {}
+        return super().tokenize(program_as_string), self.name_map
+
+    def generate_tokens(self, program_as_string):
+        tokens = list(super().generate_tokens(program_as_string))
+        self.variable_token_nums = self.find_variables(tokens)
+        return tokens
+
+    def substitute(self, token_num, tokval):
+        if token_num not in self.variable_token_nums:
+            return super().substitute(token_num, tokval)
+        if tokval not in self.name_map:
+            self.name_map[tokval] = chr(self.start_token + len(self.name_map))
+        return self.name_map[tokval]
+
+    def find_variables(self, tokens):
+        variables = set()
+        statement = None
+        brackets = []
+        lambda_depths = []
+        previous = ['', '']
+        significant = [token_num for token_num, token in enumerate(tokens) if token.type not in self.SKIPPED_TOKENS]
+        for i, token_num in enumerate(significant):
+            token = tokens[token_num]
+            following = tokens[significant[i + 1]].string if i + 1 < len(significant) else ''
+            if token.type == tokenize.NEWLINE:
+                statement = None
+                brackets = []
+                lambda_depths = []
+                previous = ['', '']
+                continue
+            if statement is None:
+                statement = token.string
+
+            if token.type == tokenize.OP:
+                if token.string == '(':
+                    if previous[0] == 'def':
+                        brackets.append('parameters')
+                    elif tokens[significant[i - 1]].type == tokenize.NAME and not keyword.iskeyword(previous[1]) \
+                            or previous[1] in (')', ']'):
+                        brackets.append('call')
+                    else:
+                        brackets.append('other')
+                elif token.string in ('[', '{'):
+                    brackets.append('other')
+                elif token.string in (')', ']', '}') and brackets:
+                    brackets.pop()
+                elif token.string == ':' and lambda_depths and lambda_depths[-1] == len(brackets):
+                    lambda_depths.pop()
+            elif token.type == tokenize.NAME and self.is_variable(token.string, previous[1], following, statement,
+                                                                  brackets, lambda_depths):
+                variables.add(token_num)
+            elif token.string == 'lambda':
+                lambda_depths.append(len(brackets))
+            previous = [previous[1], token.string]
+        return variables
+
+    def is_variable(self, name, previous, following, statement, brackets, lambda_depths):
+        if keyword.iskeyword(name) or statement in self.NAMELESS_STATEMENTS:
+            return False
+        # Attributes and the names of functions and classes
+        if previous in ('.', 'def', 'class'):
+            return False
+        if statement == 'except' and previous == 'as':
+            return False
+        # Parameters of lambdas and functions, but not their defaults or annotations
+        if lambda_depths and lambda_depths[-1] == len(brackets) and previous in ('lambda', ',', '*', '**'):
+            return False
+        if brackets and brackets[-1] == 'parameters' and previous in ('(', ',', '*', '**'):
+            return False
+        # Keyword arguments
+        if brackets and brackets[-1] == 'call' and previous in ('(', ',') and following == '=':
+            return False
+        return True
+
+
+def tokenize_python(program_as_string, return_name_map=False, single_pass=False):
     # If the program string comes with a bunch of silly extra indents, get rid of them!
     indent_level = 0
     char = program_as_string[0]
     while char == ' ':
         indent_level += 1
         char = program_as_string[indent_level]
-    variables_tokenized, _ = NameTokenizer(utf8char).tokenize(program_as_string)
-    syntax_tokenized = SyntaxTokenizer(word_to_token).tokenize(variables_tokenized)
+    if single_pass:
+        syntax_tokenized, name_map = StreamTokenizer(word_to_token, utf8char).tokenize(program_as_string)
+    else:
+        variables_tokenized, name_map = NameTokenizer(utf8char).tokenize(program_as_string)
+        syntax_tokenized = SyntaxTokenizer(word_to_token).tokenize(variables_tokenized)
+    if return_name_map:
+        return syntax_tokenized, name_map
     return syntax_tokenized
 
 
@@ -145,21 +263,14 @@ def untokenize_python(string, token_to_name):
         return array
 
     def apply_syntax(raw_tokens):
-        if len(raw_tokens) is 0:
+        if len(raw_tokens) == 0:
             return
         name = raw_tokens[0]
-        if len(raw_tokens) is 1:
+        if len(raw_tokens) == 1:
             return name
         params = raw_tokens[1:]
-        new_params_str = ''
-        for i, param in enumerate(params):
-            new_params_str += param
-            if i < len(params) - 1:
-                new_params_str += ', '
-        return name + '(' + new_params_str + ')'
-
-    class_re = re.compile(word_to_token['class'] + r'([\s\S]*?)' + word_to_token[':'] + word_to_token['\n'])
-    def_re = re.compile(word_to_token['def'] + r'([\s\S]*?)' + word_to_token[':'] + word_to_token['\n'])
+        return name + '(' + ', '.join(params) + ')'
+
     for match in re.findall(class_re, string):
         raw = remove_all(match.split(' '), '')
         string = string.replace(match.strip(), apply_syntax(raw))
@@ -167,7 +278,7 @@ def untokenize_python(string, token_to_name):
         raw = remove_all(match.split(' '), '')
         string = string.replace(match.strip(), apply_syntax(raw))
 
-    formatted = ''
+    formatted = []
     indent_level = 0
     for line in string.split(word_to_token['\n']):
         if line.startswith(word_to_token['indent']):
@@ -177,31 +288,23 @@ def untokenize_python(string, token_to_name):
             while line.startswith(word_to_token['dedent']):
                 indent_level -= 1
                 line = line[1:]
-        indents = ''.join('    ' for _ in range(indent_level))
-        formatted_line = indents + line
-        formatted += formatted_line + '\n'
+        formatted.append('    ' * indent_level + line + '\n')
 
-    for t in token_to_word:
-        formatted = formatted.replace(t, token_to_word[t])
-
-    for t in token_to_name:
-        formatted = formatted.replace(t, token_to_name[t])
+    # Keywords take precedence over names, as they did when each was replaced in turn
+    translation_table = {ord(t): name for t, name in token_to_name.items()}
+    translation_table.update(token_to_word_table)
+    formatted = ''.join(formatted).translate(translation_table)
 
     # Final assigning of unmapped variables to new temp variables
-    formatted = list(formatted)
     temp_vars = {}
-    temp_num = 0
-    for i, char in enumerate(formatted):
-        if ord(char) >= TOKEN_RANGE_START:
-            if char not in temp_vars:
-                var_name = 'temp' + str(temp_num)
-                temp_vars[char] = var_name
-                temp_num += 1
-            else:
-                var_name = temp_vars[char]
-            formatted[i] = var_name
 
-    return ''.join(formatted)
+    def temp_var(match):
+        char = match.group(0)
+        if char not in temp_vars:
+            temp_vars[char] = 'temp' + str(len(temp_vars))
+        return temp_vars[char]
+
+    return unmapped_token_re.sub(temp_var, formatted)
 
 
 def split_tokenized_files(string):
@@ -225,40 +328,45 @@ for word in c_keywords:
 var_char_index_c = utf8char_c
 
 token_to_word_c = {v: k for k, v in word_to_token_c.items()}
+token_to_word_c_table = {ord(t): ' ' + word + ' ' for t, word in token_to_word_c.items()}
 
 punctuation_mirror = { '=': '=', '-': '-', '+': '+', '&': '&', '|': '|' }
 
 # TODO: tokenize #include <...>
 
+c_comment_re = re.compile(
+    r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
+    re.DOTALL | re.MULTILINE
+)
+c_header_re = re.compile(r'#include<([\s|\S]*?)>')
 
-def tokenize_c(text, var_char_index=var_char_index_c):
-    def strip_preprocessing(text):
-        def comment_replacer(match):
-            s = match.group(0)
-            if s.startswith('/'):
-                return ""
-            else:
-                return s
+UNSAVED_FILE_NAME_C = 'program.c'
+clang_state = threading.local()
 
-        def header_replacer(match):
-            s = match.group(0)
+
+def strip_preprocessing(text):
+    def comment_replacer(match):
+        s = match.group(0)
+        if s.startswith('/'):
             return ""
+        else:
+            return s
+
+    no_comments = re.sub(c_comment_re, comment_replacer, text)
+    return re.sub(c_header_re, "", no_comments)
+
 
-        pattern = re.compile(
-            r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-            re.DOTALL | re.MULTILINE
-        )
-        no_comments = re.sub(pattern, comment_replacer, text)
-        pattern = re.compile(r'#include<([\s|\S]*?)>')
-        return re.sub(pattern, header_replacer, no_comments)
+def get_clang_index():
+    # Creating an index is expensive so each worker thread keeps one for its lifetime
+    if not hasattr(clang_state, 'index'):
+        clang_state.index = clang.cindex.Index.create()
+    return clang_state.index
 
-    index = clang.cindex.Index.create()
+
+def tokenize_c(text, var_char_index=var_char_index_c):
     text = strip_preprocessing(text)
-    f = tempfile.TemporaryFile(mode='r+', suffix='.c')
-    f.write(text)
-    f.read()
-    tu = index.parse(f.name)
-    f.close()
+    # Parsed straight from memory, the file name only has to be consistent
+    tu = get_clang_index().parse(UNSAVED_FILE_NAME_C, unsaved_files=[(UNSAVED_FILE_NAME_C, text)])
 
     tokens = tu.cursor.get_tokens()
     processed_tokens = []
@@ -300,25 +408,29 @@ def tokenize_c(text, var_char_index=var_char_index_c):
     return output, variable_names
 
 
+def tokenize_c_many(programs, var_char_index=var_char_index_c):
+    # Tokenizes a batch with a single libclang index, programs which fail to tokenize give the exception raised
+    results = []
+    for program in programs:
+        try:
+            results.append(tokenize_c(program, var_char_index))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 def untokenize_c(text, token_to_name):
-    name_to_token = {v: k for k, v in token_to_name.items()}
-    out = text
-    for variable in name_to_token:
-        out = out.replace(name_to_token[variable], (" " + variable + " "))
-    for token in token_to_word_c:
-        out = out.replace(token, (" " + token_to_word_c[token]) + " ")
-
-    list_tokenized = list(out)
+    # Variable names take precedence over keywords, as they did when each was replaced in turn
+    translation_table = dict(token_to_word_c_table)
+    translation_table.update({ord(t): ' ' + name + ' ' for t, name in token_to_name.items()})
+    out = text.translate(translation_table)
+
     temp_vars = {}
-    temp_num = 0
-    for i, char in enumerate(list_tokenized):
-        if ord(char) > TOKEN_RANGE_START:
-            if char not in temp_vars:
-                temp_name = 'temp' + str(temp_num)
-                list_tokenized[i] = ' ' + temp_name + ' '
-            else:
-                out[i] = temp_vars[char]
-            temp_num += 1
-    out = ''.join(list_tokenized)
 
-    return out
+    def temp_var(match):
+        char = match.group(0)
+        if char not in temp_vars:
+            temp_vars[char] = ' temp' + str(len(temp_vars)) + ' '
+        return temp_vars[char]
+
+    return unmapped_token_re.sub(temp_var, out)
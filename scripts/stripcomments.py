@@ -5,6 +5,7 @@ import re
 
 
 ERROR_LOG_FILE = os.path.join(ERROR_LOG_PATH, 'stripcomments.csv')
+JOURNAL_FILE = os.path.join(ERROR_LOG_PATH, 'stripcomments.journal')
 
 
 def strip_comments(file_path):
@@ -22,4 +23,4 @@ if __name__ == '__main__':
 
     content = get_file_paths()
 
-    iterate(strip_comments, ERROR_LOG_FILE, content)
\ No newline at end of file
+    iterate(strip_comments, ERROR_LOG_FILE, content, backend=PROCESS_BACKEND, journal_file_path=JOURNAL_FILE)
\ No newline at end of file
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+
+# This script is used for measuring the training throughput, step latency and peak memory of model configurations
+# on a fixed synthetic corpus, to find the cheapest model which is good enough.
+
+
+# IMPORTS #
+
+
+import modelconfig
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
+
+
+# CONSTANTS #
+
+
+SYNTHETIC_SEED = 1234
+
+
+# ARGPARSE #
+
+
+parser = argparse.ArgumentParser(description='Measure CBT training throughput for several configurations', prog='CBT')
+parser.add_argument('sweep_file', help='A json list of config overrides, or a json object mapping config options to lists of values to try every combination of')
+parser.add_argument('--vocab_size', help='The vocabulary size of the synthetic corpus, the default is 200', type=int, default=200)
+parser.add_argument('--steps', help='The number of measured training steps per configuration, the default is 50', type=int, default=50)
+parser.add_argument('--warmup_steps', help='The number of unmeasured steps run first, the default is 5', type=int, default=5)
+parser.add_argument('--output', help='A jsonl file to append the results to', default='sweep_results.jsonl')
+
+
+# FUNCTIONS #
+
+
+def expand_sweep(sweep):
+    if isinstance(sweep, list):
+        return sweep
+    options = sorted(sweep)
+    return [dict(zip(options, values)) for values in itertools.product(*(sweep[option] for option in options))]
+
+
+def synthetic_batches(config, vocab_size, num_batches):
+    # The same seed every run so configurations are compared on identical data
+    random = np.random.RandomState(SYNTHETIC_SEED)
+    return random.randint(vocab_size, size=(num_batches, config['batch_size'], config['seq_length'] + 1)).astype(np.int32)
+
+
+def get_peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(config, vocab_size, steps, warmup_steps):
+    # Run in a fresh process per configuration so the peak memory belongs to this configuration alone
+    import model_maker
+    import train
+
+    model = model_maker.build_model_from_config(config, vocab_size)
+    model.compile(optimizer='adam', loss=train.loss)
+
+    step_times = []
+    for i, batch in enumerate(synthetic_batches(config, vocab_size, warmup_steps + steps)):
+        start = time.perf_counter()
+        model.train_on_batch(batch[:, :-1], batch[:, 1:])
+        if i >= warmup_steps:
+            step_times.append(time.perf_counter() - start)
+
+    tokens_per_step = config['batch_size'] * config['seq_length']
+    return {
+        'config': config,
+        'tokens_per_second': tokens_per_step * len(step_times) / sum(step_times),
+        'step_latency_median': float(np.median(step_times)),
+        'step_latency_p90': float(np.percentile(step_times, 90)),
+        'peak_memory_mb': get_peak_memory_mb()
+    }
+
+
+# MAIN #
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.sweep_file) as fp:
+        configs = [modelconfig.load_config(**overrides) for overrides in expand_sweep(json.load(fp))]
+
+    context = multiprocessing.get_context('spawn')
+    for i, config in enumerate(configs):
+        print('Measuring configuration {}/{}: {}'.format(i + 1, len(configs), config))
+        with context.Pool(1) as pool:
+            result = pool.apply(measure, (config, args.vocab_size, args.steps, args.warmup_steps))
+        print('{:.0f} tokens/s, median step {:.4f}s, p90 step {:.4f}s, peak memory {} MB'.format(
+            result['tokens_per_second'], result['step_latency_median'], result['step_latency_p90'], result['peak_memory_mb']))
+        with open(args.output, 'a') as fp:
+            fp.write(json.dumps(result) + '\n')
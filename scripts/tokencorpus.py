@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+
+# This script is used for storing a tokenized corpus as uint16 token ids which can be memory mapped for training.
+#
+# File layout (little endian):
+#   header   magic, vocabulary size in bytes, number of programs, number of tokens
+#   vocab    json list of tokens, the index of a token is its id
+#   ids      uint16 token id per token, programs concatenated in order
+#   offsets  uint64 start of every program in ids plus the end of the last one
+# Sections after the header are padded to 8 bytes so they can be mapped directly.
+
+
+# IMPORTS #
+
+
+import numpy as np
+import json
+import os
+import struct
+import itertools
+
+
+# CONSTANTS #
+
+
+MAGIC = b'CBTCORP1'
+HEADER = struct.Struct('<8sQQQ')
+ALIGNMENT = 8
+TOKEN_DTYPE = np.uint16
+OFFSET_DTYPE = np.uint64
+ENCODE_BATCH_SIZE = 1000
+
+
+# FUNCTIONS #
+
+
+def aligned(position):
+    return position + (-position) % ALIGNMENT
+
+
+def to_code_points(text):
+    return np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+
+
+def build_vocabulary(text):
+    # Returns the sorted vocabulary, the same as sorted(set(text)), and text encoded with it in one numpy pass
+    unique, inverse = np.unique(to_code_points(text), return_inverse=True)
+    if len(unique) > np.iinfo(TOKEN_DTYPE).max + 1:
+        raise ValueError('A vocabulary of {} tokens does not fit in {}'.format(len(unique), np.dtype(TOKEN_DTYPE).name))
+    return [chr(code_point) for code_point in unique], inverse.astype(TOKEN_DTYPE)
+
+
+def build_vocabulary_from_chunks(texts):
+    # Streaming version of build_vocabulary for corpora which don't fit in memory, only returns the vocabulary
+    code_points = np.zeros(0, dtype=np.uint32)
+    for text in texts:
+        code_points = np.union1d(code_points, to_code_points(text))
+    return [chr(code_point) for code_point in code_points]
+
+
+class TokenEncoder:
+    def __init__(self, token_to_index):
+        tokens = sorted(token_to_index, key=ord)
+        self.code_points = np.array([ord(t) for t in tokens], dtype=np.uint32)
+        self.token_ids = np.array([token_to_index[t] for t in tokens], dtype=TOKEN_DTYPE)
+
+    def encode(self, text):
+        code_points = to_code_points(text)
+        if not len(self.code_points):
+            if len(code_points):
+                raise KeyError(text[0])
+            return np.zeros(0, dtype=TOKEN_DTYPE)
+        positions = np.minimum(np.searchsorted(self.code_points, code_points), len(self.code_points) - 1)
+        unknown = np.flatnonzero(self.code_points[positions] != code_points)
+        if len(unknown):
+            raise KeyError(text[unknown[0]])
+        return self.token_ids[positions]
+
+
+def encode(text, token_to_index):
+    return TokenEncoder(token_to_index).encode(text)
+
+
+def write_corpus(path, programs, vocab):
+    # programs is an iterable of tokenized programs, every token in them must be in vocab
+    if len(vocab) > np.iinfo(TOKEN_DTYPE).max + 1:
+        raise ValueError('A vocabulary of {} tokens does not fit in {}'.format(len(vocab), np.dtype(TOKEN_DTYPE).name))
+    encoder = TokenEncoder({t: i for i, t in enumerate(vocab)})
+    vocab_bytes = json.dumps(list(vocab)).encode('utf-8')
+
+    offsets = [0]
+    programs = iter(programs)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(vocab_bytes), 0, 0))
+        f.write(vocab_bytes)
+        f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+        # Programs are encoded a batch at a time, most are far too small to be worth a numpy call each
+        batch = list(itertools.islice(programs, ENCODE_BATCH_SIZE))
+        while batch:
+            f.write(encoder.encode(''.join(batch)).tobytes())
+            for program in batch:
+                offsets.append(offsets[-1] + len(program))
+            batch = list(itertools.islice(programs, ENCODE_BATCH_SIZE))
+        f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+        f.write(np.array(offsets, dtype=OFFSET_DTYPE).tobytes())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(vocab_bytes), len(offsets) - 1, offsets[-1]))
+    os.replace(path + '.tmp', path)
+
+
+class Corpus:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, vocab_size, num_programs, num_tokens = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('{} is not a tokenized corpus file'.format(path))
+            self.vocab = json.loads(f.read(vocab_size).decode('utf-8'))
+        self.token_to_index = {t: i for i, t in enumerate(self.vocab)}
+
+        ids_start = aligned(HEADER.size + vocab_size)
+        offsets_start = aligned(ids_start + num_tokens * np.dtype(TOKEN_DTYPE).itemsize)
+        # np.memmap can't map zero length arrays
+        self.token_ids = np.memmap(path, dtype=TOKEN_DTYPE, mode='r', offset=ids_start, shape=(num_tokens,)) \
+            if num_tokens else np.zeros(0, dtype=TOKEN_DTYPE)
+        self.offsets = np.memmap(path, dtype=OFFSET_DTYPE, mode='r', offset=offsets_start, shape=(num_programs + 1,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_program(self, i):
+        return self.token_ids[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def get_program_text(self, i):
+        return ''.join(self.vocab[token_id] for token_id in self.get_program(i))
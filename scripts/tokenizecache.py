@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+
+# This script is used for caching tokenized programs on disk so unchanged programs are not re-tokenized between runs.
+
+
+# IMPORTS #
+
+
+import iteratortools as it
+import programtokenizer
+import os
+import time
+import json
+import hashlib
+import sqlite3
+
+
+# CONSTANTS #
+
+
+CACHE_PATH = os.path.join(it.REPO_ROOT_PATH, 'data', 'tokenize_cache.sqlite')
+MAX_CACHE_BYTES = 4 * 1024 ** 3
+# Evicting down to a fraction of the limit means we don't evict again on the very next insert
+EVICT_TO_FRACTION = 0.9
+
+
+# FUNCTIONS #
+
+
+def cache_key(language, program, single_pass=False):
+    key = hashlib.sha256()
+    key.update(language.lower().encode('utf-8'))
+    key.update(b'single_pass' if single_pass else b'ast')
+    key.update(str(programtokenizer.TOKENIZER_VERSION).encode('utf-8'))
+    key.update(programtokenizer.get_vocabulary_hash(language).encode('utf-8'))
+    key.update(program.encode('utf-8', 'surrogatepass'))
+    return key.hexdigest()
+
+
+class TokenizeCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tokenized '
+            '(key TEXT PRIMARY KEY, tokenized TEXT, variables TEXT, size INTEGER, last_used REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tokenized_last_used ON tokenized (last_used)')
+
+    def get_cached_keys(self, keys):
+        cached = set()
+        for key in keys:
+            if self.connection.execute('SELECT 1 FROM tokenized WHERE key = ?', (key,)).fetchone():
+                cached.add(key)
+        return cached
+
+    def get(self, key):
+        row = self.connection.execute('SELECT tokenized, variables FROM tokenized WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE tokenized SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row[0], json.loads(row[1])
+
+    def put(self, key, tokenized, variables):
+        variables = json.dumps(variables)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO tokenized VALUES (?, ?, ?, ?, ?)',
+            (key, tokenized, variables, len(tokenized) + len(variables), time.time())
+        )
+
+    def get_size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM tokenized').fetchone()[0]
+
+    def evict(self):
+        # Least recently used entries go first
+        size = self.get_size()
+        if size <= self.max_bytes:
+            return 0
+        excess = size - self.max_bytes * EVICT_TO_FRACTION
+        evicted = 0
+        for key, size in self.connection.execute('SELECT key, size FROM tokenized ORDER BY last_used').fetchall():
+            if excess <= 0:
+                break
+            self.connection.execute('DELETE FROM tokenized WHERE key = ?', (key,))
+            excess -= size
+            evicted += 1
+        return evicted
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.commit()
+        self.connection.close()
@@ -9,21 +9,65 @@ import os
 import iteratortools as it
 import programtokenizer
 import model_maker
+import modelconfig
 import json
 import sys
+import argparse
 import convertto3 as p23
+import multiprocessing
+import functools
+import shutil
+import itertools
+import tokenizecache
+import tokencorpus
+import dedup
+import datetime
+import time
+import hashlib
+import re
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 # CONSTANTS #
 
 
 ERROR_LOG_FILE = os.path.join(it.ERROR_LOG_PATH, 'modelload.csv')
+TOKENIZE_ERROR_LOG_FILE = os.path.join(it.ERROR_LOG_PATH, 'tokenize.csv')
+
+TOKENIZED_SHARD_SIZE = 1000
+TOKENIZE_CHUNK_SIZE = 16
+TOKENIZER_INFO_FILE = 'tokenizer.json'
+CORPUS_EXTENSION = '.bin'
+
+WINDOW_BLOCK_SIZE = 256
+INTERLEAVE_CYCLE_LENGTH = 4
 
-BATCH_SIZE = 64
 BUFFER_SIZE = 10000
-WORD_TO_INDEX_FILE = 'word_to_index.json'
+WORD_TO_INDEX_FILE = modelconfig.WORD_TO_INDEX_FILE
+TRAINING_LOG_FILE = 'training_log.jsonl'
+TRAINING_STATE_FILE = 'training_state.json'
+THROUGHPUT_LOG_EVERY = 10
+
+
+# ARGPARSE #
 
-EPOCHS = 10
+
+parser = argparse.ArgumentParser(description='Train a CBT code generation model', prog='CBT')
+parser.add_argument('language', help='The language to train on')
+parser.add_argument('checkpoint_dir', help='The directory to write training checkpoints to')
+parser.add_argument('portion_to_train', help='The portion of the tokenized training set to train on', type=float)
+parser.add_argument('-l', '--load_from_file', help='Train on the previously tokenized corpus instead of tokenizing it', action='store_true')
+parser.add_argument('--single_pass', help='Tokenize python on the token stream instead of round tripping through the ast', action='store_true')
+parser.add_argument('--stateful', help='Train on contiguous streams in order, carrying the LSTM state between batches', action='store_true')
+parser.add_argument('--config', help='A json file of model and training hyperparameters, see modelconfig.DEFAULT_CONFIG. Not with --resume or --incremental')
+parser.add_argument('--seq_length', help='The number of tokens in each training window, overrides the config', type=int)
+parser.add_argument('--dedup_threshold', help='Drop tokenized programs at least this similar to an earlier one, e.g. {}. Only applies when tokenizing, not with -l'.format(dedup.DEFAULT_THRESHOLD), type=float)
+parser.add_argument('--resume', help='Continue from the latest checkpoint in checkpoint_dir, with its config, vocabulary and optimizer state', action='store_true')
+parser.add_argument('--incremental', help='Continue from the latest checkpoint for another round of epochs on only the shards it has not trained on', action='store_true')
 
 
 # FUNCTIONS #
@@ -39,123 +83,597 @@ def loss(labels, logits):
     return tf.keras.losses.sparse_categorical_crossentropy(labels, logits, from_logits=True)
 
 
-def write_index(index, checkpoint_dir, vocab_size, variable_char_start):
+def write_index(index, checkpoint_dir, vocab_size, variable_char_start, single_pass_tokenizer=False):
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     with open(os.path.join(checkpoint_dir, WORD_TO_INDEX_FILE), 'w') as fp:
-        json.dump({'index_to_token': index, 'vocab_size': vocab_size, 'variable_char_start': variable_char_start}, fp)
+        json.dump({'index_to_token': index, 'vocab_size': vocab_size, 'variable_char_start': variable_char_start,
+                   'single_pass_tokenizer': single_pass_tokenizer}, fp)
+
+
+def read_index_vocab(checkpoint_dir):
+    with open(os.path.join(checkpoint_dir, WORD_TO_INDEX_FILE)) as fp:
+        token_to_index = json.load(fp)['index_to_token']
+    return sorted(token_to_index, key=token_to_index.get)
+
+
+def read_training_state(checkpoint_dir):
+    # The epoch to continue from, the epoch the run was going to, the shards the run trains on and the shards trained on
+    # by finished runs. Falls back to the number in the checkpoint name for checkpoints written before the state file was.
+    latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    if latest_checkpoint is None:
+        return None
+    state_path = os.path.join(checkpoint_dir, TRAINING_STATE_FILE)
+    state = {'target_epochs': None, 'run_shards': None, 'trained_shards': []}
+    if os.path.exists(state_path):
+        with open(state_path) as fp:
+            state.update(json.load(fp))
+    else:
+        match = re.search(r'ckpt_(\d+)$', latest_checkpoint)
+        state['epoch'] = int(match.group(1)) if match else 0
+    state['checkpoint'] = latest_checkpoint
+    return state
 
 
-def tokenize_c(programs):
-    tokenized = []
-    print("Tokenizing C programs:")
-    progress_bar = it.ProgressBar(0, len(programs))
-    progress_bar.print_progress_bar()
-    for program in programs:
-        try:
-            tokenized.append(programtokenizer.tokenize_c(program)[0])
-            progress_bar.increment_work()
-        except Exception:
-            progress_bar.increment_errors()
-        finally:
-            progress_bar.print_progress_bar()
-    return "".join(tokenized)
+class TrainingStateCallback(tf.keras.callbacks.Callback):
+    # Written after every epoch's checkpoint, so a preempted run can pick up where it left off. The run's shards are only
+    # added to the trained shards once its last epoch has finished.
+    def __init__(self, checkpoint_dir, target_epochs, trained_shards, run_shards):
+        super().__init__()
+        self.state_path = os.path.join(checkpoint_dir, TRAINING_STATE_FILE)
+        self.target_epochs = target_epochs
+        self.trained_shards = trained_shards
+        self.run_shards = run_shards
+        self.epoch = None
+
+    def write(self):
+        with open(self.state_path + '.tmp', 'w') as fp:
+            json.dump({'epoch': self.epoch, 'target_epochs': self.target_epochs,
+                       'trained_shards': self.trained_shards, 'run_shards': self.run_shards}, fp)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        self.write()
 
+    def on_train_end(self, logs=None):
+        if self.epoch == self.target_epochs:
+            self.trained_shards = sorted(set(self.trained_shards) | {digest for digest, _, whole in self.run_shards if whole})
+            self.write()
 
-def tokenize_python(programs):
 
+def tokenized_shard_dir(lang):
+    return os.path.join(it.REPO_ROOT_PATH, 'data', '{}_tokenized'.format(lang.lower()))
+
+
+def read_converted_python_programs():
+    # Python programs are tokenized from the python 3 versions written by convertto3.py
     programs = []
     for filename in os.listdir(os.path.join(os.getcwd(), 'temp')):
         with open(os.path.join(os.getcwd(), 'temp', filename), encoding='utf8') as f:
             programs += [f.read()]
+    return programs
 
-    tokenized = []
-    print("Tokenizing Python Programs:")
 
-    progress_bar = it.ProgressBar(0, len(programs))
-    progress_bar.print_progress_bar()
+def tokenize_chunk(lang, single_pass, programs):
+    # Runs in a worker process, returns a (tokenized, variables, error) triple per program
+    if lang == 'c':
+        return [(None, None, str(tokenized)) if isinstance(tokenized, Exception) else tokenized + (None,)
+                for tokenized in programtokenizer.tokenize_c_many(programs)]
+    results = []
     for program in programs:
         try:
             program = p23.normalize_indenting(program)
-            tokenized.append(programtokenizer.tokenize_python(program))
-            progress_bar.increment_work()
-        except Exception:
-            progress_bar.increment_errors()
-        finally:
-            progress_bar.print_progress_bar()
-    return "".join(tokenized)
+            results.append(programtokenizer.tokenize_python(program, return_name_map=True, single_pass=single_pass) + (None,))
+        except Exception as e:
+            results.append((None, None, str(e)))
+    return results
 
 
-def tokenize_lang(programs, lang):
-    if lang.lower() == "c":
-        text = tokenize_c(programs)
-    elif lang.lower() == "python":
-        text = tokenize_python(programs)
-    else:
+def write_shard(shard_dir, shard_num, tokenized_programs):
+    shard_path = os.path.join(shard_dir, 'shard_{:05d}.jsonl'.format(shard_num))
+    with open(shard_path + '.tmp', 'w', encoding='utf8') as f:
+        for tokenized in tokenized_programs:
+            f.write(json.dumps(tokenized) + '\n')
+    os.replace(shard_path + '.tmp', shard_path)
+    return shard_path
+
+
+def write_tokenizer_info(shard_dir, single_pass):
+    with open(os.path.join(shard_dir, TOKENIZER_INFO_FILE), 'w') as fp:
+        json.dump({'tokenizer_version': programtokenizer.TOKENIZER_VERSION, 'single_pass': single_pass}, fp)
+
+
+def read_tokenizer_info(shard_dir):
+    if not os.path.exists(os.path.join(shard_dir, TOKENIZER_INFO_FILE)):
+        return {'single_pass': False}
+    with open(os.path.join(shard_dir, TOKENIZER_INFO_FILE)) as fp:
+        return json.load(fp)
+
+
+def get_shard_paths(shard_dir):
+    return sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir) if name.endswith('.jsonl'))
+
+
+def read_shard(shard_path):
+    with open(shard_path, encoding='utf8') as f:
+        return [json.loads(line) for line in f]
+
+
+def tokenize_to_shards(programs, lang, shard_dir, single_pass=False):
+    # Programs are tokenized in parallel and written, in order, to shards of TOKENIZED_SHARD_SIZE programs.
+    # Only programs missing from the tokenize cache are sent to the workers.
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    write_tokenizer_info(shard_dir, single_pass)
+
+    cache = tokenizecache.TokenizeCache()
+    keys = [tokenizecache.cache_key(lang, program, single_pass) for program in programs]
+    cached_keys = cache.get_cached_keys(keys)
+    uncached_programs = [program for program, key in zip(programs, keys) if key not in cached_keys]
+    print('{} of {} programs found in the tokenize cache'.format(len(programs) - len(uncached_programs), len(programs)))
+
+    print("Tokenizing {} programs:".format(lang))
+    progress_bar = it.ProgressBar(0, len(programs))
+    progress_bar.print_progress_bar()
+
+    shard_paths = []
+    shard = []
+    try:
+        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+            tokenize = functools.partial(tokenize_chunk, lang, single_pass)
+            results = itertools.chain.from_iterable(pool.imap(tokenize, it.chunks(uncached_programs, TOKENIZE_CHUNK_SIZE)))
+            for program_num, key in enumerate(keys):
+                if key in cached_keys:
+                    tokenized, _ = cache.get(key)
+                    error = None
+                else:
+                    tokenized, variables, error = next(results)
+                    if error is None:
+                        cache.put(key, tokenized, variables)
+
+                if error is not None:
+                    progress_bar.increment_errors()
+                    it.handle_exception(TOKENIZE_ERROR_LOG_FILE, program_num, 'Error tokenizing program', error)
+                else:
+                    shard.append(tokenized)
+                if len(shard) == TOKENIZED_SHARD_SIZE:
+                    shard_paths.append(write_shard(shard_dir, len(shard_paths), shard))
+                    shard = []
+                    cache.commit()
+                progress_bar.increment_work()
+                progress_bar.print_progress_bar()
+        if shard:
+            shard_paths.append(write_shard(shard_dir, len(shard_paths), shard))
+    finally:
+        cache.close()
+    return shard_paths
+
+
+def shard_signatures(shard_path):
+    # Runs in a worker process
+    return dedup.get_signatures(read_shard(shard_path))
+
+
+def deduplicate_shards(shard_dir, threshold):
+    # Signatures are computed a shard per worker, then the shards are rewritten in order without the near duplicates
+    shard_paths = get_shard_paths(shard_dir)
+    print('Removing near duplicate programs:')
+    progress_bar = it.ProgressBar(0, len(shard_paths))
+    progress_bar.print_progress_bar()
+
+    dedup_dir = shard_dir + '.dedup'
+    if os.path.exists(dedup_dir):
+        shutil.rmtree(dedup_dir)
+    os.makedirs(dedup_dir)
+    index = dedup.LSHIndex(threshold)
+    programs = tokens = kept_programs = kept_tokens = 0
+    new_shard_paths = []
+    shard = []
+    with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+        for shard_path, signatures in zip(shard_paths, pool.imap(shard_signatures, shard_paths)):
+            for tokenized, signature in zip(read_shard(shard_path), signatures):
+                programs += 1
+                tokens += len(tokenized)
+                if index.add_if_unique(signature):
+                    kept_programs += 1
+                    kept_tokens += len(tokenized)
+                    shard.append(tokenized)
+                if len(shard) == TOKENIZED_SHARD_SIZE:
+                    new_shard_paths.append(write_shard(dedup_dir, len(new_shard_paths), shard))
+                    shard = []
+            progress_bar.increment_work()
+            progress_bar.print_progress_bar()
+    if shard:
+        new_shard_paths.append(write_shard(dedup_dir, len(new_shard_paths), shard))
+
+    info = read_tokenizer_info(shard_dir)
+    info['dedup_threshold'] = threshold
+    with open(os.path.join(dedup_dir, TOKENIZER_INFO_FILE), 'w') as fp:
+        json.dump(info, fp)
+    shutil.rmtree(shard_dir)
+    os.rename(dedup_dir, shard_dir)
+
+    print('Removed {} of {} programs ({:.1%}) and {} of {} tokens ({:.1%}) as near duplicates'.format(
+        programs - kept_programs, programs, (programs - kept_programs) / programs if programs else 0,
+        tokens - kept_tokens, tokens, (tokens - kept_tokens) / tokens if tokens else 0))
+    return [os.path.join(shard_dir, os.path.basename(shard_path)) for shard_path in new_shard_paths]
+
+
+def build_corpus_shards(shard_dir, vocab=None):
+    # Every tokenized shard gets a binary corpus next to it, all sharing one vocabulary. The vocabulary is only
+    # rebuilt (re-reading every shard) when a binary shard is missing or older than its tokenized shard.
+    # Passing vocab encodes the shards with that vocabulary instead, e.g. the one a checkpoint was trained with.
+    shard_paths = get_shard_paths(shard_dir)
+    corpus_paths = [os.path.splitext(shard_path)[0] + CORPUS_EXTENSION for shard_path in shard_paths]
+    stale = [not os.path.exists(corpus_path) or os.path.getmtime(shard_path) > os.path.getmtime(corpus_path)
+             for shard_path, corpus_path in zip(shard_paths, corpus_paths)]
+    if corpus_paths and not any(stale) and (vocab is None or tokencorpus.Corpus(corpus_paths[0]).vocab == vocab):
+        return corpus_paths, tokencorpus.Corpus(corpus_paths[0]).vocab
+
+    print('Building binary corpus shards...')
+    if vocab is None:
+        vocab = tokencorpus.build_vocabulary_from_chunks("".join(read_shard(shard_path)) for shard_path in shard_paths)
+    for shard_path, corpus_path, is_stale in zip(shard_paths, corpus_paths, stale):
+        if is_stale or tokencorpus.Corpus(corpus_path).vocab != vocab:
+            try:
+                tokencorpus.write_corpus(corpus_path, read_shard(shard_path), vocab)
+            except KeyError as e:
+                raise ValueError('{} has the token {!r} which is not in the vocabulary'.format(shard_path, e.args[0]))
+    return corpus_paths, vocab
+
+
+def get_shard_digest(corpus_path):
+    # Shards are renumbered whenever the corpus is re-tokenized, so they are identified by the content of the tokenized shard
+    digest = hashlib.sha1()
+    with open(os.path.splitext(corpus_path)[0] + '.jsonl', 'rb') as f:
+        for block in iter(functools.partial(f.read, 1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_run_shards(corpus_shards):
+    # [digest, tokens used, whether that is the whole shard] per shard, a shard only counts as trained on if all of its
+    # tokens were used
+    return [[get_shard_digest(corpus_path), token_limit, token_limit == len(tokencorpus.Corpus(corpus_path).token_ids)]
+            for corpus_path, token_limit in corpus_shards]
+
+
+def find_run_shards(corpus_paths, run_shards):
+    # The (corpus path, token limit) pairs of a run's shards, or None if some of them have changed since it started
+    digest_to_path = {get_shard_digest(corpus_path): corpus_path for corpus_path in corpus_paths}
+    if any(digest not in digest_to_path for digest, _, _ in run_shards):
+        return None
+    return [(digest_to_path[digest], token_limit) for digest, token_limit, _ in run_shards]
+
+
+def select_corpus_shards(corpus_paths, portion_to_train):
+    # The first portion_to_train of the tokens, as (corpus path, number of tokens to use) pairs
+    sizes = [len(tokencorpus.Corpus(corpus_path).token_ids) for corpus_path in corpus_paths]
+    remaining = int(sum(sizes) * portion_to_train)
+    selected = []
+    for corpus_path, size in zip(corpus_paths, sizes):
+        if remaining <= 0:
+            break
+        selected.append((corpus_path, min(size, remaining)))
+        remaining -= size
+    return selected
+
+
+def read_windows(corpus_path, token_limit, seq_length):
+    # Yields blocks of consecutive seq_length + 1 windows straight from the memory mapped shard
+    token_ids = tokencorpus.Corpus(corpus_path.decode('utf-8')).token_ids[:token_limit]
+    windows = token_ids[:len(token_ids) // (seq_length + 1) * (seq_length + 1)].reshape(-1, seq_length + 1)
+    for start in range(0, len(windows), WINDOW_BLOCK_SIZE):
+        yield windows[start:start + WINDOW_BLOCK_SIZE].astype(np.int32)
+
+
+def read_contiguous_batches(corpus_paths, token_limits, seq_length, batch_size):
+    # Lays the corpus out as batch_size contiguous streams and yields the consecutive windows of every stream, so the
+    # state a stateful LSTM carries from one batch to the next belongs to the same stream of text
+    token_ids = [tokencorpus.Corpus(corpus_path.decode('utf-8')).token_ids[:token_limit]
+                 for corpus_path, token_limit in zip(corpus_paths, token_limits)]
+    shard_starts = np.cumsum([0] + [len(shard_token_ids) for shard_token_ids in token_ids])
+    stream_length = int(shard_starts[-1]) // batch_size
+
+    def read_tokens(start, stop):
+        pieces = []
+        shard = int(np.searchsorted(shard_starts, start, side='right')) - 1
+        while start < stop:
+            shard_stop = min(stop, int(shard_starts[shard + 1]))
+            pieces.append(token_ids[shard][start - int(shard_starts[shard]):shard_stop - int(shard_starts[shard])])
+            start = shard_stop
+            shard += 1
+        return np.concatenate(pieces)
+
+    for step in range((stream_length - 1) // seq_length):
+        window_start = step * seq_length
+        batch = np.stack([read_tokens(stream * stream_length + window_start, stream * stream_length + window_start + seq_length + 1)
+                          for stream in range(batch_size)]).astype(np.int32)
+        yield batch[:, :-1], batch[:, 1:]
+
+
+def make_contiguous_dataset(corpus_shards, seq_length, batch_size):
+    # Batches come in order and are not shuffled, for stateful (truncated BPTT) training
+    corpus_paths, token_limits = zip(*corpus_shards)
+    dataset = tf.data.Dataset.from_generator(
+        read_contiguous_batches,
+        output_types=(tf.int32, tf.int32),
+        output_shapes=(tf.TensorShape([batch_size, seq_length]), tf.TensorShape([batch_size, seq_length])),
+        args=(list(corpus_paths), list(token_limits), seq_length, batch_size)
+    )
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+class ResetStatesCallback(tf.keras.callbacks.Callback):
+    def on_epoch_begin(self, epoch, logs=None):
+        self.model.reset_states()
+
+
+def get_rss_mb():
+    # Current resident set size, from /proc where available, otherwise the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    # Appends json lines of step and epoch timings to log_path. Keras pulls each batch from the dataset inside the train
+    # step, so the dataset has to go through time_dataset, which notes when each batch comes out of the input pipeline.
+    # Time from the start of a step until its batch was ready is counted as waiting on the input pipeline, the rest of
+    # the step as compute. The first step of a run also builds the train function, so it is logged as warmup instead.
+    def __init__(self, log_path, tokens_per_step, config=None, log_every=THROUGHPUT_LOG_EVERY):
+        super().__init__()
+        self.log_path = log_path
+        self.tokens_per_step = tokens_per_step
+        self.config = config
+        self.log_every = log_every
+        self.run = datetime.datetime.now().isoformat()
+        self.log_file = None
+        self.batch_ready = None
+
+    def mark_batch_ready(self):
+        self.batch_ready = time.perf_counter()
+        return self.batch_ready
+
+    def time_dataset(self, dataset):
+        def mark_ready(*batch):
+            # Runs when the train step pulls the batch, after any waiting on the prefetch buffer
+            ready = tf.py_function(self.mark_batch_ready, [], tf.float64)
+            with tf.control_dependencies([ready]):
+                return tuple(tf.identity(tensor) for tensor in batch)
+        return dataset.map(mark_ready)
+
+    def write(self, record):
+        record.update({'run': self.run, 'time': time.time(), 'rss_mb': get_rss_mb()})
+        self.log_file.write(json.dumps(record) + '\n')
+        self.log_file.flush()
+
+    def on_train_begin(self, logs=None):
+        self.warmed_up = False
+        self.log_file = open(self.log_path, 'a')
+        self.write({'type': 'run', 'config': self.config, 'tokens_per_step': self.tokens_per_step})
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.epoch_steps = 0
+        self.epoch_wait = 0.0
+        self.epoch_compute = 0.0
+        self.epoch_warmup = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        # A batch ready before the step started (or a dataset which wasn't timed) had no wait
+        ready = self.batch_ready if self.batch_ready is not None and self.step_start <= self.batch_ready <= step_end else self.step_start
+        step_wait = ready - self.step_start
+        step_compute = step_end - ready
+        self.epoch_steps += 1
+        if not self.warmed_up:
+            self.warmed_up = True
+            self.epoch_warmup += step_end - self.step_start
+            return
+        self.epoch_wait += step_wait
+        self.epoch_compute += step_compute
+        if self.epoch_steps % self.log_every == 0:
+            step_time = step_end - self.step_start
+            self.write({
+                'type': 'step',
+                'step': self.epoch_steps,
+                'step_time': step_time,
+                'data_wait_time': step_wait,
+                'compute_time': step_compute,
+                'tokens_per_second': self.tokens_per_step / step_time if step_time else None,
+                'loss': float(logs['loss']) if logs and 'loss' in logs else None
+            })
+
+    def on_epoch_end(self, epoch, logs=None):
+        wall_time = time.perf_counter() - self.epoch_start
+        self.write({
+            'type': 'epoch',
+            'epoch': epoch,
+            'steps': self.epoch_steps,
+            'wall_time': wall_time,
+            'data_wait_time': self.epoch_wait,
+            'compute_time': self.epoch_compute,
+            'warmup_time': self.epoch_warmup,
+            'tokens_per_second': self.tokens_per_step * self.epoch_steps / wall_time if wall_time else None,
+            'loss': float(logs['loss']) if logs and 'loss' in logs else None
+        })
+
+    def on_train_end(self, logs=None):
+        self.log_file.close()
+
+
+def make_dataset(corpus_shards, seq_length, batch_size):
+    # Streams windows from the corpus shards, reading several shards in parallel, so the corpus never has to fit in memory
+    corpus_paths, token_limits = zip(*corpus_shards)
+
+    def shard_windows(corpus_path, token_limit):
+        return tf.data.Dataset.from_generator(
+            read_windows,
+            output_types=tf.int32,
+            output_shapes=tf.TensorShape([None, seq_length + 1]),
+            args=(corpus_path, token_limit, seq_length)
+        ).unbatch()
+
+    dataset = tf.data.Dataset.from_tensor_slices((list(corpus_paths), list(token_limits)))
+    dataset = dataset.interleave(shard_windows, cycle_length=INTERLEAVE_CYCLE_LENGTH,
+                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(split_input_target, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.shuffle(BUFFER_SIZE).batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def tokenize_lang(programs, lang, single_pass=False):
+    lang = lang.lower()
+    if lang == "python":
+        programs = read_converted_python_programs()
+    elif lang != "c":
         print("Sorry, we don't have a tokenizer in place for {}".format(lang))
         sys.exit(1)
-    return text
+    return tokenize_to_shards(programs, lang, tokenized_shard_dir(lang), single_pass)
 
 
 # MAIN METHOD #
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     print('Scanning contents of files into memory')
-    lang = sys.argv[1]
-    checkpoint_dir = os.path.join('.', sys.argv[2])
-    portion_to_train = float(sys.argv[3])
-    if len(sys.argv) > 4 and sys.argv[4] == '-l':
-        load_from_file = True
+    lang = args.language
+    checkpoint_dir = os.path.join('.', args.checkpoint_dir)
+    portion_to_train = args.portion_to_train
+    load_from_file = args.load_from_file
+    single_pass = args.single_pass
+    if args.dedup_threshold is not None and not 0 < args.dedup_threshold <= 1:
+        parser.error('--dedup_threshold must be between 0 and 1')
+    if args.dedup_threshold is not None and load_from_file:
+        parser.error('--dedup_threshold is applied while tokenizing, run without -l to deduplicate')
+    if args.resume and args.incremental:
+        parser.error('Please specify either --resume or --incremental, not both')
+    resume = args.resume or args.incremental
+    if resume and args.config:
+        parser.error('--resume and --incremental use the config saved with the checkpoint, leave out --config')
+    training_state = read_training_state(checkpoint_dir) if resume else None
+    if resume and training_state is None:
+        parser.error('--resume and --incremental need a checkpoint in {}'.format(checkpoint_dir))
+    if resume:
+        # The model has to be rebuilt exactly as it was checkpointed
+        config = modelconfig.read_checkpoint_config(checkpoint_dir)
+        if args.seq_length is not None:
+            config['seq_length'] = args.seq_length
+        print('Resuming from {} after epoch {}'.format(training_state['checkpoint'], training_state['epoch']))
+    else:
+        config = modelconfig.load_config(args.config, seq_length=args.seq_length)
+    seq_length = config['seq_length']
+    initial_epoch = training_state['epoch'] if resume else 0
+    run_unfinished = resume and training_state['target_epochs'] is not None and initial_epoch < training_state['target_epochs']
+    if args.resume:
+        # Continue toward the epoch the run was going to
+        epochs = training_state['target_epochs'] or config['epochs']
+        if initial_epoch >= epochs:
+            print('Already trained for {} epochs'.format(initial_epoch))
+            sys.exit(0)
+    elif args.incremental:
+        if run_unfinished:
+            print('The last run stopped after epoch {} of {}, finish it with --resume first'.format(
+                initial_epoch, training_state['target_epochs']))
+            sys.exit(1)
+        epochs = initial_epoch + config['epochs']
     else:
-        load_from_file = False
+        epochs = config['epochs']
+    trained_shards = training_state['trained_shards'] if resume else []
+    run_shards = []
+    callbacks = []
     # if lang.lower() in 'python':
     #     file_paths = it.get_file_paths()
     #     text = get_as_file(file_paths)
     # else:
     if load_from_file:
-        with open(os.path.join(it.REPO_ROOT_PATH, "data", "{}_tokenized.txt".format(lang)), encoding='utf8') as f:
-            text = f.read()
-            text = text[:int(len(text) * 0.7)]
+        shard_dir = tokenized_shard_dir(lang)
+        if os.path.exists(shard_dir):
+            # Shards are built from the training split only
+            single_pass = read_tokenizer_info(shard_dir)['single_pass']
+            if resume:
+                # Shards are encoded with the checkpoint's vocabulary, they can't add tokens the model has no embedding for
+                try:
+                    corpus_paths, vocab = build_corpus_shards(shard_dir, read_index_vocab(checkpoint_dir))
+                except ValueError as e:
+                    print('The shards are not compatible with the checkpoint vocabulary, train from scratch instead: {}'.format(e))
+                    sys.exit(1)
+            else:
+                corpus_paths, vocab = build_corpus_shards(shard_dir)
+            if run_unfinished and training_state['run_shards'] is not None:
+                # The same shards the run started on
+                corpus_shards = find_run_shards(corpus_paths, training_state['run_shards'])
+                if corpus_shards is None:
+                    print('Some of the shards the run started on have changed since, it can not be resumed')
+                    sys.exit(1)
+            else:
+                if args.incremental:
+                    corpus_paths = [corpus_path for corpus_path in corpus_paths if get_shard_digest(corpus_path) not in trained_shards]
+                    if not corpus_paths:
+                        print('No new shards to train on')
+                        sys.exit(0)
+                corpus_shards = select_corpus_shards(corpus_paths, portion_to_train)
+            run_shards = get_run_shards(corpus_shards)
+            print('Length of text: {} tokens in {} shards'.format(sum(limit for _, limit in corpus_shards), len(corpus_shards)))
+            if args.stateful:
+                dataset = make_contiguous_dataset(corpus_shards, seq_length, config['batch_size'])
+                callbacks.append(ResetStatesCallback())
+            else:
+                dataset = make_dataset(corpus_shards, seq_length, config['batch_size'])
+        else:
+            if args.stateful:
+                parser.error('--stateful needs the tokenized shards, run without -l first')
+            if args.incremental:
+                parser.error('--incremental needs the tokenized shards, run without -l first')
+            with open(os.path.join(it.REPO_ROOT_PATH, "data", "{}_tokenized.txt".format(lang)), encoding='utf8') as f:
+                text = f.read()
+                text = text[:int(len(text) * 0.7)]
+            text = text[:int(len(text) * portion_to_train)]
+            vocab, text_as_int = tokencorpus.build_vocabulary(text)
+            if resume and vocab != read_index_vocab(checkpoint_dir):
+                print('The corpus vocabulary has changed since the checkpoint')
+                sys.exit(1)
+            print('Length of text: {} tokens'.format(len(text_as_int)))
+
+            # Create training examples/targets
+            char_dataset = tf.data.Dataset.from_tensor_slices(text_as_int.astype(np.int32))
+            sequences = char_dataset.batch(seq_length + 1, drop_remainder=True)
+
+            dataset = sequences.map(split_input_target)
+            dataset = dataset.shuffle(BUFFER_SIZE).batch(config['batch_size'], drop_remainder=True)
     else:
+        if resume:
+            parser.error('--resume and --incremental train on the tokenized corpus, add -l')
         programs = it.get_lang_files(lang, training_only=True)
-        if len(programs) is 0:
+        if len(programs) == 0:
             print('No files found with {} as a language'.format(lang))
             sys.exit(1)
-        text = tokenize_lang(programs, lang)
-        with open("py_tokenized.txt", "w", encoding='utf8') as f:
-            f.write(text)
-            sys.exit(0)
-
-    text = text[:int(len(text) * portion_to_train)]
+        shard_paths = tokenize_lang(programs, lang, single_pass)
+        if args.dedup_threshold is not None:
+            shard_paths = deduplicate_shards(tokenized_shard_dir(lang), args.dedup_threshold)
+        print('Wrote {} tokenized shards to {}'.format(len(shard_paths), tokenized_shard_dir(lang)))
+        sys.exit(0)
 
-    print('Length of text: {} characters'.format(len(text)))
-    vocab = sorted(set(text))
     print('{} unique tokens'.format(len(vocab)))
 
     token_to_index = {t: i for i, t in enumerate(vocab)}
-    index_to_token = np.array(vocab)
-    write_index(token_to_index, checkpoint_dir, len(vocab), programtokenizer.get_var_char_index())
-    text_as_int = np.array([token_to_index[t] for t in text])
-
-    seq_length = 100
-    examples_per_epoch = len(text)//seq_length
-
-    # Create training examples/targets
-    char_dataset = tf.data.Dataset.from_tensor_slices(text_as_int)
-    sequences = char_dataset.batch(seq_length + 1, drop_remainder=True)
-
-    dataset = sequences.map(split_input_target)
-    dataset = dataset.shuffle(BUFFER_SIZE).batch(BATCH_SIZE, drop_remainder=True)
+    write_index(token_to_index, checkpoint_dir, len(vocab), programtokenizer.get_var_char_index(), single_pass)
+    modelconfig.write_config(config, checkpoint_dir)
 
     # Model:
     vocab_size = len(vocab)
-    model = model_maker.build_model(
-        vocab_size=len(vocab),
-        embedding_dim=model_maker.EMBEDDING_DIMENSION,
-        rnn_units=model_maker.RNN_UNITS,
-        batch_size=BATCH_SIZE
-    )
+    model = model_maker.build_model_from_config(config, len(vocab))
 
     for input_example_batch, target_example_batch in dataset.take(1):
         example_batch_predictions = model(input_example_batch)
@@ -167,6 +685,10 @@ if __name__ == '__main__':
         print("scalar_loss:      ", example_batch_loss.numpy().mean())
 
     model.compile(optimizer='adam', loss=loss)
+    if resume:
+        # The checkpoints are in the tensorflow format, which also holds the optimizer's slots and iteration count.
+        # Those are restored as soon as the optimizer creates them on the first step.
+        model.load_weights(training_state['checkpoint'])
 
     # Checkpoints:
     checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt_{epoch}")
@@ -175,4 +697,12 @@ if __name__ == '__main__':
         save_weights_only=True
     )
 
-    history = model.fit(dataset, epochs=EPOCHS, callbacks=[checkpoint_callback])
+    throughput_callback = ThroughputCallback(
+        os.path.join(checkpoint_dir, TRAINING_LOG_FILE), config['batch_size'] * seq_length, config
+    )
+    dataset = throughput_callback.time_dataset(dataset)
+    callbacks.append(throughput_callback)
+
+    callbacks.append(TrainingStateCallback(checkpoint_dir, epochs, trained_shards, run_shards))
+
+    history = model.fit(dataset, epochs=epochs, initial_epoch=initial_epoch, callbacks=[checkpoint_callback] + callbacks)